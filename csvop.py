@@ -11,6 +11,23 @@ __all__ = ["addcolumn", "dropcolumn", "merge", "select"]
 import csv
 import os
 import itertools
+import ast
+import io
+import json
+import mmap
+import struct
+import random
+import heapq
+import shutil
+import tempfile
+import multiprocessing
+from datetime import datetime
+from collections import OrderedDict
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 def read_csv(filename):
     with open(filename, 'rbU') as infile:
@@ -20,6 +37,50 @@ def read_csv(filename):
             data.append(row)
         return data
 
+def iter_csv(filename):
+    """Lazily yield the rows of a csv file without loading it all into memory.
+    
+    >>> make_csv('__test__.csv', [['a', 'b'], [0, 1], [2, 3]])
+    >>> rows = iter_csv('__test__.csv')
+    >>> next(rows)
+    ['a', 'b']
+    >>> list(rows)
+    [['0', '1'], ['2', '3']]
+    >>> os.remove('__test__.csv')
+    """
+    with open(filename, 'rbU') as infile:
+        reader = csv.reader(infile)
+        for row in reader:
+            yield row
+
+def iter_csv_offsets(filename, offset=0):
+    """Lazily yield (row, end) pairs starting at byte offset, where end is the
+    byte offset just past the row. Passing a previous end back in as offset
+    resumes reading at the next row; quoted newlines are handled by csv.
+    
+    >>> make_csv('__test__.csv', [['a', 'b'], ['x', 'two\\nlines'], [2, 3]])
+    >>> rows = list(iter_csv_offsets('__test__.csv'))
+    >>> [row for row, end in rows]
+    [['a', 'b'], ['x', 'two\\nlines'], ['2', '3']]
+    >>> [row for row, end in iter_csv_offsets('__test__.csv', rows[1][1])]
+    [['2', '3']]
+    >>> os.remove('__test__.csv')
+    """
+    with open(filename, 'rb') as infile:
+        infile.seek(offset)
+        position = [offset]
+        
+        def lines():
+            while True:
+                line = infile.readline()
+                if not line:
+                    return
+                position[0] += len(line)
+                yield line
+        
+        for row in csv.reader(lines()):
+            yield row, position[0]
+
 def make_csv(filename, values):
     with open(filename, 'wb') as outfile:
         writer = csv.writer(outfile)
@@ -27,20 +88,377 @@ def make_csv(filename, values):
             writer.writerow(row)
         
 def csv_header(filename):
+    info = _info_cache.get(filename)
+    if info is not None and info['key'] == _stat_key(filename):
+        return list(info['header'])
+    
     with open(filename, 'rbU') as infile:
         reader = csv.reader(infile)
         header = reader.next()
         return header
 
 def count_rows(filename):
-    with open(filename, 'rbU') as infile:
-        reader = csv.reader(infile)
-        
-        count = 0
-        for row in reader:
-            count += 1
-            
-        return count
+    return csv_info(filename)['rows']
+
+SCAN_BLOCK_BYTES = 16 * 1024 * 1024
+DEFAULT_OFFSET_STRIDE = 100000
+INFO_CACHE_MIN_BYTES = 64 * 1024 * 1024
+
+class _QuoteScanner:
+    """Follow whether the bytes of a csv file fed to it block by block are
+    inside a quoted value, the way csv.reader reads them: a quote only opens
+    a quoted value at the start of a field, a doubled quote inside one stands
+    for a quote, and any other quote is part of the value.
+    
+    >>> scanner = _QuoteScanner()
+    >>> list(scanner.segments('a,"b\\n""c",5" wide\\n'))
+    [(0, 'a,'), (9, ',5'), (12, ' wide\\n')]
+    >>> scanner.quoted
+    False
+    """
+    
+    def __init__(self):
+        self.quoted = False
+        # the last quote closed a quoted value, so another one right after it is doubled
+        self.closed = False
+        self.previous = '\n'
+    
+    def segments(self, block):
+        """Yield (position, segment) for the stretches of block outside quoted values."""
+        position = 0
+        for i, segment in enumerate(block.split('"')):
+            if i:
+                if self.quoted:
+                    self.quoted = False
+                    self.closed = True
+                elif self.closed or self.previous in ',\r\n':
+                    self.quoted = True
+                    self.closed = False
+                self.previous = '"'
+                position += 1
+            if segment:
+                self.closed = False
+                self.previous = segment[-1]
+                if not self.quoted:
+                    yield position, segment
+            position += len(segment)
+    
+    def feed(self, block):
+        for _ in self.segments(block):
+            pass
+
+def _unquoted_segments(data, size, scanner):
+    """Yield (position, segment) for the stretches of data outside quoted values,
+    reading it SCAN_BLOCK_BYTES at a time."""
+    for start in xrange(0, size, SCAN_BLOCK_BYTES):
+        for position, segment in scanner.segments(data[start:start + SCAN_BLOCK_BYTES]):
+            yield start + position, segment
+
+def scan_rows(filename, stride=DEFAULT_OFFSET_STRIDE):
+    """Count the rows of a csv file by scanning it in large blocks, returning
+    (rows, offsets) where offsets[k] is the byte offset at which row k * stride
+    starts. Newlines inside a quoted value do not end a row.
+    
+    >>> make_csv('__test__.csv', [['a', 'b'], ['x', 'two\\nlines'], [2, 3], [4, 5]])
+    >>> scan_rows('__test__.csv', 2)
+    (4, [0, 20])
+    >>> read_csv_range('__test__.csv', 20, os.path.getsize('__test__.csv'))
+    [['2', '3'], ['4', '5']]
+    
+    A quote inside an unquoted value does not start a quoted one
+    
+    >>> with open('__test__.csv', 'wb') as outfile:
+    ...     outfile.write('name,size\\npipe,5" wide\\nbolt,3\\nnut,4\\n')
+    >>> scan_rows('__test__.csv', 2)
+    (4, [0, 23])
+    >>> os.remove('__test__.csv')
+    """
+    size = os.path.getsize(filename)
+    rows = 0
+    offsets = [0]
+    if not size:
+        return rows, offsets
+    
+    with open(filename, 'rb') as infile:
+        data = mmap.mmap(infile.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            scanner = _QuoteScanner()
+            for position, segment in _unquoted_segments(data, size, scanner):
+                count = segment.count('\n')
+                # note where every stride-th row starts
+                while rows + count >= stride * len(offsets):
+                    end = _nth_newline(segment, stride * len(offsets) - rows)
+                    offsets.append(position + end + 1)
+                rows += count
+            if data[size - 1] != '\n' or scanner.quoted:
+                # the last row has no line ending
+                rows += 1
+        finally:
+            data.close()
+    
+    if offsets[-1] >= size:
+        offsets.pop()
+    return rows, offsets
+
+def _nth_newline(text, n):
+    """The index of the n-th newline in text, counting from 1.
+    
+    >>> _nth_newline('a\\nb\\nc\\n', 2)
+    3
+    """
+    # narrow it down a window at a time, then find the last few one by one
+    start = 0
+    while True:
+        count = text.count('\n', start, start + 65536)
+        if count >= n:
+            break
+        n -= count
+        start += 65536
+    end = start - 1
+    for i in xrange(n):
+        end = text.index('\n', end + 1)
+    return end
+
+_info_cache = {}
+def _stat_key(filename):
+    stat = os.stat(filename)
+    return [stat.st_size, stat.st_mtime]
+
+def csv_info(filename, min_cache_bytes=INFO_CACHE_MIN_BYTES):
+    """Return a dictionary of the header, row count ('rows') and row offsets
+    (see scan_rows) of a csv file.
+    
+    For files of at least min_cache_bytes the result is kept in memory and in
+    a FILENAME.csvinfo file next to it, keyed by the file's size and
+    modification time, so that later calls on an unchanged file don't read it.
+    
+    Prepare the test
+    
+    >>> make_csv('__test__.csv', [['a', 'b'], [0, 1], [2, 3]])
+    
+    Test reading and caching the info
+    
+    >>> info = csv_info('__test__.csv', min_cache_bytes=0)
+    >>> info['header'], info['rows'], info['offsets']
+    (['a', 'b'], 3, [0])
+    >>> os.path.isfile('__test__.csv.csvinfo')
+    True
+    >>> _info_cache.clear()
+    >>> csv_info('__test__.csv', min_cache_bytes=0)['rows']
+    3
+    >>> csv_header('__test__.csv'), count_rows('__test__.csv')
+    (['a', 'b'], 3)
+    
+    Clean up
+    
+    >>> os.remove('__test__.csv.csvinfo')
+    >>> os.remove('__test__.csv')
+    """
+    key = _stat_key(filename)
+    cached = key[0] >= min_cache_bytes
+    sidecar = filename + '.csvinfo'
+    
+    info = _info_cache.get(filename)
+    if cached and (info is None or info['key'] != key) and os.path.isfile(sidecar):
+        try:
+            with open(sidecar, 'rb') as infile:
+                info = json.load(infile)
+            # the header is stored as latin-1 so that any bytes survive
+            info['header'] = [name.encode('latin-1') for name in info['header']]
+        except (IOError, ValueError, KeyError):
+            info = None
+    if info is not None and info['key'] == key and info['stride'] == DEFAULT_OFFSET_STRIDE:
+        return info
+    
+    rows, offsets = scan_rows(filename)
+    header = csv_header(filename) if rows else []
+    info = {'key': key, 'header': header, 'rows': rows,
+            'stride': DEFAULT_OFFSET_STRIDE, 'offsets': offsets}
+    
+    if cached:
+        _info_cache[filename] = info
+        try:
+            with open(sidecar, 'wb') as outfile:
+                json.dump(dict(info, header=[name.decode('latin-1') for name in header]), outfile)
+        except (IOError, OSError):
+            # a read-only directory only costs the cache
+            pass
+    return info
+
+ROW_INDEX_SUFFIX = '.csvidx'
+# little-endian unsigned 64-bit, the same on every platform
+_OFFSET_TYPE = '<Q'
+_OFFSET_SIZE = struct.calcsize(_OFFSET_TYPE)
+
+def _write_offsets(outfile, offsets):
+    outfile.write(struct.pack('<%dQ' % len(offsets), *offsets))
+
+def _index_key(filename):
+    size, mtime = _stat_key(filename)
+    return [size, int(mtime * 1000000)]
+
+def build_row_index(filename):
+    """Write the byte offset at which each row of a csv file starts to
+    FILENAME.csvidx in one pass over the file, and return it as a RowIndex.
+    
+    The index file is a sequence of little-endian unsigned 64-bit integers
+    (struct format '<Q'): the size and modification time (in microseconds)
+    of the csv file, the offset of every row, and the size of the file again
+    to close the last row.
+    """
+    index_file = filename + ROW_INDEX_SUFFIX
+    size, mtime = _index_key(filename)
+    
+    with open(filename, 'rb') as infile, open(index_file + '.tmp', 'wb') as outfile:
+        offsets = [size, mtime, 0]
+        last = 0
+        if size:
+            data = mmap.mmap(infile.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                for position, segment in _unquoted_segments(data, size, _QuoteScanner()):
+                    end = segment.find('\n')
+                    while end != -1:
+                        offsets.append(position + end + 1)
+                        end = segment.find('\n', end + 1)
+                    if len(offsets) >= 65536:
+                        last = offsets[-1]
+                        _write_offsets(outfile, offsets)
+                        del offsets[:]
+            finally:
+                data.close()
+        if offsets:
+            last = offsets[-1]
+        if last != size:
+            # the last row has no line ending
+            offsets.append(size)
+        _write_offsets(outfile, offsets)
+    
+    os.rename(index_file + '.tmp', index_file)
+    return RowIndex(filename)
+
+def row_index(filename, build=True):
+    """Return the RowIndex of a csv file, building it if it is missing or
+    older than the file. With build=False, return None instead of building."""
+    index_file = filename + ROW_INDEX_SUFFIX
+    if os.path.isfile(index_file):
+        index = RowIndex(filename)
+        if index.key == _index_key(filename):
+            return index
+        index.close()
+    
+    if build:
+        return build_row_index(filename)
+    return None
+
+class RowIndex:
+    """Random access to the rows of a csv file through the offsets written by
+    build_row_index. Row 0 is the header.
+    
+    Prepare the test
+    
+    >>> make_csv('__test__.csv', [['a', 'b'], ['x', 'two\\nlines'], [2, 3], [4, 5]])
+    
+    Test reading rows by number
+    
+    >>> index = build_row_index('__test__.csv')
+    >>> index.rows
+    4
+    >>> index.read(2, 4)
+    [['2', '3'], ['4', '5']]
+    >>> list(index.get([3, 1]))
+    [['4', '5'], ['x', 'two\\nlines']]
+    
+    Test splitting the rows into ranges
+    
+    >>> index.row_ranges(2)
+    [(1, 2), (2, 4)]
+    >>> list(index.chunks(10))
+    [(5, 20), (20, 30)]
+    
+    Test that the index is reused until the file changes
+    
+    >>> index.close()
+    >>> row_index('__test__.csv', build=False).rows
+    4
+    >>> with open('__test__.csv', 'ab') as outfile:
+    ...     outfile.write('6,7\\r\\n')
+    >>> print row_index('__test__.csv', build=False)
+    None
+    >>> row_index('__test__.csv').rows
+    5
+    
+    Test that a quote inside an unquoted value does not hide the rows after it
+    
+    >>> with open('__test__.csv', 'wb') as outfile:
+    ...     outfile.write('name,size\\npipe,5" wide\\nbolt,3\\nnut,4\\n')
+    >>> index = row_index('__test__.csv')
+    >>> index.rows, index.read(3, 4)
+    (4, [['nut', '4']])
+    >>> index.close()
+    
+    Clean up
+    
+    >>> os.remove('__test__.csv.csvidx')
+    >>> os.remove('__test__.csv')
+    """
+    
+    def __init__(self, filename):
+        self.filename = filename
+        with open(filename + ROW_INDEX_SUFFIX, 'rb') as infile:
+            self._data = mmap.mmap(infile.fileno(), 0, access=mmap.ACCESS_READ)
+        self.key = [self._entry(0), self._entry(1)]
+        self.rows = len(self._data) // _OFFSET_SIZE - 3
+    
+    def _entry(self, i):
+        return struct.unpack_from(_OFFSET_TYPE, self._data, i * _OFFSET_SIZE)[0]
+    
+    def offset(self, row):
+        """The byte offset at which a row starts; offset(rows) is the end of the file."""
+        if not 0 <= row <= self.rows:
+            raise IndexError('row %d out of range' % (row))
+        return self._entry(row + 2)
+    
+    def read(self, start, stop):
+        """Return rows start up to stop."""
+        return read_csv_range(self.filename, self.offset(start), self.offset(stop))
+    
+    def get(self, rows):
+        """Yield the given rows, seeking to each one in turn."""
+        with open(self.filename, 'rb') as infile:
+            for row in rows:
+                start = self.offset(row)
+                infile.seek(start)
+                data = infile.read(self.offset(row + 1) - start)
+                for values in csv.reader(io.BytesIO(data)):
+                    yield values
+    
+    def row_ranges(self, parts, first=1):
+        """Split the rows from first onwards into at most parts (start, stop) ranges of about
+        the same number of rows. The byte range of each is (offset(start), offset(stop))."""
+        count = self.rows - first
+        parts = max(1, min(parts, count))
+        bounds = [first + count * i // parts for i in range(parts + 1)]
+        return [(start, stop) for start, stop in zip(bounds, bounds[1:]) if start < stop]
+    
+    def chunks(self, chunk_bytes, first=1):
+        """Yield (start, end) byte ranges of whole rows from row first onwards,
+        each about chunk_bytes long, as row_chunks does but without scanning the file."""
+        row = first
+        while row < self.rows:
+            # the first row past the target size, by binary search
+            target = self.offset(row) + chunk_bytes
+            low, high = row + 1, self.rows
+            while low < high:
+                middle = (low + high) // 2
+                if self.offset(middle) < target:
+                    low = middle + 1
+                else:
+                    high = middle
+            yield self.offset(row), self.offset(low)
+            row = low
+    
+    def close(self):
+        self._data.close()
 
 def _convert_numbers(row):
     """Convert any numeric members of the array to be numbers.
@@ -65,6 +483,88 @@ def _convert_numbers(row):
                 pass
     return row
         
+DATE_FORMATS = ['%Y-%m-%d', '%Y-%m-%d %H:%M:%S', '%Y-%m-%dT%H:%M:%S', '%Y/%m/%d', '%Y/%m/%d %H:%M:%S', '%Y%m%d']
+
+def parse_date(value):
+    """Parse a date in one of the DATE_FORMATS, returning None if none match.
+    
+    >>> parse_date('2019-01-31')
+    datetime.datetime(2019, 1, 31, 0, 0)
+    >>> parse_date('2019/01/31 12:30:00')
+    datetime.datetime(2019, 1, 31, 12, 30)
+    >>> parse_date('31 Jan') is None
+    True
+    """
+    for fmt in DATE_FORMATS:
+        try:
+            return datetime.strptime(value, fmt)
+        except ValueError:
+            pass
+    return None
+
+def zero_padded(value):
+    """Whether a cell is a number written with leading zeros, such as the code
+    007, which would lose them if converted.
+    
+    >>> [zero_padded(v) for v in ['007', '-012', '0', '0.5', '10']]
+    [True, True, False, False, False]
+    """
+    digits = value.strip().lstrip('+-')
+    return len(digits) > 1 and digits[0] == '0' and digits[1].isdigit()
+
+def cell_type(value):
+    """Detect the type of a single cell the way _convert_numbers does, plus dates.
+    Empty cells have no type, and numbers with leading zeros are strings.
+    
+    >>> [cell_type(v) for v in ['4', '-2.4', '2019-01-31', 'abc', '', '007']]
+    ['int', 'float', 'date', 'string', None, 'string']
+    """
+    if value == '':
+        return None
+    if not zero_padded(value):
+        try:
+            int(value)
+            return 'int'
+        except ValueError:
+            pass
+        try:
+            float(value)
+            return 'float'
+        except ValueError:
+            pass
+    # plain numbers such as 20190131 were already taken as ints
+    if parse_date(value) is not None:
+        return 'date'
+    return 'string'
+
+def _widen_type(current, found):
+    if current is None or current == found:
+        return found
+    if found is None:
+        return current
+    if set([current, found]) == set(['int', 'float']):
+        return 'float'
+    return 'string'
+
+def infer_types(filename, sample_rows=1000):
+    """Guess a type (int, float, date or string) for each column from the first
+    sample_rows rows. A column is only numeric or a date if every non-empty
+    sampled cell is; ints mixed with floats become float.
+    
+    >>> make_csv('__test__.csv', [['a', 'b', 'c', 'd', 'e', 'code'],
+    ...                           [1, '1.5', '2019-01-31', 'x', '', '007'], [2, 3, '2019-02-01', 4, '', '12']])
+    >>> infer_types('__test__.csv')
+    [('a', 'int'), ('b', 'float'), ('c', 'date'), ('d', 'string'), ('e', 'string'), ('code', 'string')]
+    >>> os.remove('__test__.csv')
+    """
+    rows = iter_csv(filename)
+    header = next(rows)
+    types = [None] * len(header)
+    for row in itertools.islice(rows, sample_rows):
+        for i, value in enumerate(row[:len(header)]):
+            types[i] = _widen_type(types[i], cell_type(value))
+    return [(name, t or 'string') for name, t in zip(header, types)]
+
 def col_reference(header, name=None, index=None):
     """Get the index of a column given a name or index
     
@@ -143,6 +643,7 @@ def write_csv(iterator, filename, header=None, generator=None):
     If header is supplied, it is inserted prior to processing the rows.
     
     If a generator is supplied, it is used to process each row before output.
+    Rows for which it returns None are left out.
     """
     if os.path.isfile(filename):
         if not confirm("Overwrite %s?" %(filename)):
@@ -164,6 +665,8 @@ def write_csv(iterator, filename, header=None, generator=None):
         for row in iterator:
             if generator is not None:
                 row = generator(rowsWritten, row)
+                if row is None:
+                    continue
             
             if not colCount:
                 colCount = len(row)
@@ -173,13 +676,402 @@ def write_csv(iterator, filename, header=None, generator=None):
             
     print 'Wrote %d rows and %d columns to %s' %(rowsWritten, colCount, filename)
 
+DEFAULT_CHUNK_BYTES = 16 * 1024 * 1024
+
+_processes = 1
+_chunk_bytes = DEFAULT_CHUNK_BYTES
+def parallel(processes=None, chunk_bytes=None):
+    """Process the rows of large inputs in a pool of processes.
     
-def _addcolumn_process(args):
+    With processes=None every core is used; processes=1 restores the
+    single reader loop. Chunks are roughly chunk_bytes long.
+    """
+    global _processes, _chunk_bytes
+    _processes = multiprocessing.cpu_count() if processes is None else processes
+    _chunk_bytes = DEFAULT_CHUNK_BYTES if chunk_bytes is None else chunk_bytes
+
+def row_chunks(filename, chunk_bytes=DEFAULT_CHUNK_BYTES, offset=0):
+    """Yield (start, end) byte ranges of about chunk_bytes each, starting at offset,
+    whose ends fall on row boundaries. A newline inside a quoted value does not
+    end a row, so quoted newlines are never split.
+    
+    >>> make_csv('__test__.csv', [['a', 'b'], ['x', 'two\\nlines'], [2, 3]])
+    >>> chunks = list(row_chunks('__test__.csv', 4))
+    >>> chunks
+    [(0, 5), (5, 20), (20, 25)]
+    >>> [read_csv_range('__test__.csv', start, end) for start, end in chunks]
+    [[['a', 'b']], [['x', 'two\\nlines']], [['2', '3']]]
+    
+    A quote inside an unquoted value does not start a quoted one
+    
+    >>> with open('__test__.csv', 'wb') as outfile:
+    ...     outfile.write('a,5" b\\nc,"d\\ne"\\nf,g\\n')
+    >>> chunks = list(row_chunks('__test__.csv', 8))
+    >>> [read_csv_range('__test__.csv', start, end) for start, end in chunks]
+    [[['a', '5" b'], ['c', 'd\\ne']], [['f', 'g']]]
+    >>> os.remove('__test__.csv')
+    """
+    with open(filename, 'rb') as infile:
+        infile.seek(offset)
+        start = offset
+        scanner = _QuoteScanner()
+        while True:
+            block = infile.read(chunk_bytes)
+            if not block:
+                break
+            scanner.feed(block)
+            
+            # finish the row the block ends in
+            if not block.endswith('\n') or scanner.quoted:
+                while True:
+                    line = infile.readline()
+                    if not line:
+                        break
+                    scanner.feed(line)
+                    if line.endswith('\n') and not scanner.quoted:
+                        break
+            
+            end = infile.tell()
+            yield start, end
+            start = end
+
+def read_csv_range(filename, start, end):
+    with open(filename, 'rb') as infile:
+        infile.seek(start)
+        data = infile.read(end - start)
+    return list(csv.reader(io.BytesIO(data)))
 
-    if args.calc is not None:
-        args.calc = eval('lambda row: %s' % (args.calc))
+_chunk_generator = None
+def _init_chunk_worker(generator):
+    global _chunk_generator
+    _chunk_generator = generator
+
+def _process_chunk(task):
+    filename, start, end = task
+    
+    outfile = io.BytesIO()
+    writer = csv.writer(outfile)
+    rows = 0
+    colCount = 0
+    # row numbers restart in each chunk but never reach the header's 0
+    for rowNum, row in enumerate(read_csv_range(filename, start, end), 1):
+        if _chunk_generator is not None:
+            row = _chunk_generator(rowNum, row)
+            if row is None:
+                continue
+        if not colCount:
+            colCount = len(row)
+        writer.writerow(row)
+        rows += 1
+    
+    return outfile.getvalue(), rows, colCount
+
+def write_csv_parallel(input, filename, header=None, generator=None, processes=None,
+                       chunk_bytes=DEFAULT_CHUNK_BYTES):
+    """Like write_csv, but read the rows of the input file in row-aligned chunks
+    which are passed through the generator by a pool of processes. Chunks are
+    written back in order, so the output is the same as with write_csv. If the
+    input has an up to date row index, the chunks are taken from it.
+    
+    If header is supplied the first row of the input is taken to be the header
+    and is replaced by it. The generator must not rely on exact row numbers,
+    only on the header being row 0.
+    
+    Prepare the test
+    
+    >>> always_confirm(True)
+    >>> make_csv('__test__.csv', [['a', 'b']] + [[i, 'line %d\\nof %d' % (i, i)] for i in range(50)])
+    
+    Test that the output matches a single pass
+    
+    >>> def generator(rowNum, row):
+    ...     return row[::-1]
+    >>> write_csv_parallel('__test__.csv', '__test2__.csv', csv_header('__test__.csv'), generator,
+    ...                    processes=3, chunk_bytes=64)
+    Wrote 51 rows and 2 columns to __test2__.csv
+    >>> write_csv(iter_csv('__test__.csv'), '__test3__.csv', generator=generator)
+    Wrote 51 rows and 2 columns to __test3__.csv
+    >>> read_csv('__test2__.csv') == read_csv('__test3__.csv')
+    True
+    
+    Clean up
+    
+    >>> os.remove('__test3__.csv')
+    >>> os.remove('__test2__.csv')
+    >>> os.remove('__test__.csv')
+    """
+    if os.path.isfile(filename):
+        if not confirm("Overwrite %s?" %(filename)):
+            return
+
+    offset = 0
+    if header is not None:
+        for row, offset in iter_csv_offsets(input):
+            break
+    
+    # an up to date row index saves scanning for row boundaries
+    index = row_index(input, build=False)
+    
+    rowsWritten = 0
+    colCount = 0
+    pool = multiprocessing.Pool(processes, _init_chunk_worker, (generator,))
+    try:
+        with open(filename, 'wb') as outfile:
+            if header is not None:
+                if generator is not None:
+                    header = generator(rowsWritten, header)
+    
+                colCount = len(header)
+                csv.writer(outfile).writerow(header)
+                rowsWritten += 1
+            
+            if index is not None:
+                chunks = index.chunks(chunk_bytes, first=0 if header is None else 1)
+            else:
+                chunks = row_chunks(input, chunk_bytes, offset)
+            tasks = ((input, start, end) for start, end in chunks)
+            for data, rows, cols in pool.imap(_process_chunk, tasks):
+                if not colCount:
+                    colCount = cols
+                outfile.write(data)
+                rowsWritten += rows
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+        if index is not None:
+            index.close()
+    
+    print 'Wrote %d rows and %d columns to %s' %(rowsWritten, colCount, filename)
+
+def _write_rows(input, reader, output, header=None, generator=None):
+    """Write the rows of an operation, in parallel if parallel() asked for it."""
+    if _processes > 1:
+        write_csv_parallel(input, output, header=header, generator=generator,
+                           processes=_processes, chunk_bytes=_chunk_bytes)
+    else:
+        write_csv(reader, output, header=header, generator=generator)
+
+    
+DEFAULT_BLOCK_ROWS = 10000
+
+def _number(value):
+    """Convert a single cell the way _convert_numbers does.
+    
+    >>> [_number(v) for v in ['4', '-2.4', 'a', 1.5]]
+    [4, -2.4, 'a', 1.5]
+    """
+    if not isinstance(value, basestring):
+        return value
+    try:
+        return int(value)
+    except ValueError:
+        try:
+            return float(value)
+        except ValueError:
+            return value
+
+_INT64_MIN, _INT64_MAX = -2 ** 63, 2 ** 63 - 1
+
+def _column_array(values):
+    """A typed NumPy array of a column if _number converts every value to the
+    same type: int64 if they are all integers within its range, float64 if
+    they are all floats, otherwise None."""
+    values = [_number(v) for v in values]
+    kinds = set(type(v) for v in values)
+    if kinds <= set([int, long]) and _INT64_MIN <= min(values) and max(values) <= _INT64_MAX:
+        return numpy.array(values, dtype=numpy.int64)
+    if kinds == set([float]):
+        return numpy.array(values, dtype=numpy.float64)
+    return None
+
+class _ColumnNames(ast.NodeTransformer):
+    """Rewrite references to columns by name, bare or as row['name'], to row[N].
+    Called names and names bound in the expression, such as comprehension
+    variables, are left alone."""
+    
+    def __init__(self, header):
+        self.header = header
+        self.bound = set()
+    
+    def visit_Expression(self, node):
+        self.bound = set(name.id for name in ast.walk(node)
+                         if isinstance(name, ast.Name) and not isinstance(name.ctx, ast.Load))
+        return self.generic_visit(node)
+    
+    def visit_Call(self, node):
+        func = node.func
+        self.generic_visit(node)
+        if isinstance(func, ast.Name):
+            node.func = func
+        return node
+    
+    def _cell(self, name, node):
+        index = ast.Index(value=ast.Num(n=self.header.index(name)))
+        return ast.copy_location(ast.Subscript(value=ast.Name(id='row', ctx=ast.Load()), slice=index,
+                                               ctx=ast.Load()), node)
+    
+    def visit_Subscript(self, node):
+        if isinstance(node.value, ast.Name) and node.value.id == 'row' \
+                and isinstance(node.slice, ast.Index) and isinstance(node.slice.value, ast.Str):
+            name = node.slice.value.s
+            if name not in self.header:
+                raise Exception('Unknown column "%s"' %(name))
+            return self._cell(name, node)
+        return self.generic_visit(node)
+    
+    def visit_Name(self, node):
+        if node.id != 'row' and node.id in self.header and node.id not in self.bound \
+                and isinstance(node.ctx, ast.Load):
+            return self._cell(node.id, node)
+        return node
+
+def _lambda(args, body):
+    """Compile a lambda taking the named arguments from an expression tree."""
+    args = ast.arguments(args=[ast.Name(id=arg, ctx=ast.Param()) for arg in args],
+                         vararg=None, kwarg=None, defaults=[])
+    tree = ast.fix_missing_locations(ast.Expression(body=ast.Lambda(args=args, body=body)))
+    return eval(compile(tree, '<calc>', 'eval'))
+
+class _CellReferences(ast.NodeTransformer):
+    """Replace row[N] with one variable per referenced column, noting any other use of row."""
+    
+    def __init__(self):
+        self.columns = []
+        self.whole_row = False
+    
+    def visit_Subscript(self, node):
+        if isinstance(node.value, ast.Name) and node.value.id == 'row' \
+                and isinstance(node.slice, ast.Index) and isinstance(node.slice.value, ast.Num) \
+                and isinstance(node.slice.value.n, (int, long)) and node.slice.value.n >= 0:
+            i = node.slice.value.n
+            if i not in self.columns:
+                self.columns.append(i)
+            return ast.copy_location(ast.Name(id='_c%d' % i, ctx=ast.Load()), node)
+        return self.generic_visit(node)
+    
+    def visit_Name(self, node):
+        if node.id == 'row':
+            self.whole_row = True
+        return node
+
+class Calc:
+    """A calc expression over row, compiled once.
+    
+    columns lists the row indices the expression refers to, or is None if the
+    expression uses row as a whole. Only the referenced cells are converted to
+    numbers, and block() evaluates the expression over whole columns at once
+    with NumPy when it is available.
+    
+    >>> calc = Calc('row[2] * 2 + row[0]')
+    >>> calc.columns
+    [0, 2]
+    >>> calc(['1', 'x', '3'])
+    7
+    >>> calc.block([['1', 'x', '3'], ['2', 'y', '0']])
+    [7, 2]
+    >>> Calc('row[1] * 2').block([['1', 'x', '3'], ['2', '4', '0']])
+    ['xx', 8]
+    >>> print Calc('sum(row)').columns
+    None
+    
+    Given the header, columns can also be referred to by name
+    
+    >>> calc = Calc('price * row["count"]', ['name', 'price', 'count'])
+    >>> calc.columns, calc(['x', '2.5', '4'])
+    ([1, 2], 10.0)
+    
+    A bare name is not a column where it is called or bound in the expression;
+    row['name'] always is
+    
+    >>> Calc('max(row[0], row[1]) > 3', ['min', 'max'])(['1', '5'])
+    True
+    >>> Calc('len(name) > 3', ['name', 'len'])(['bolt', '2'])
+    True
+    >>> Calc('sum(len(x) for x in [name, row["x"]])', ['name', 'x'])(['ab', 'cde'])
+    5
+    """
+    
+    def __init__(self, expression, header=None):
+        self.expression = expression
+        
+        tree = ast.parse(expression.strip(), mode='eval')
+        if header is not None:
+            tree = _ColumnNames(header).visit(tree)
+        self.function = _lambda(['row'], tree.body)
+        
+        refs = _CellReferences()
+        body = refs.visit(tree).body
+        if refs.whole_row:
+            self.columns = None
+            return
         
-    return addcolumn(args.input, args.output, args.index, args.name, args.default, args.calc)
+        self.columns = sorted(refs.columns)
+        self.cells = _lambda(['_c%d' % i for i in self.columns], body)
+    
+    def __call__(self, row):
+        if self.columns is None:
+            return self.function(_convert_numbers(list(row)))
+        return self.cells(*[_number(row[i]) for i in self.columns])
+    
+    def block(self, rows):
+        """Evaluate the expression for a list of rows, returning one value per row.
+        
+        A block is only evaluated as arrays when the cells of each column it uses
+        all convert to the same type, so that the values are the same as row by
+        row. NumPy integers wrap silently on overflow, so results over integer
+        columns are checked against the expression evaluated in floating point,
+        and blocks where the two disagree are evaluated row by row, as are
+        blocks with non-numeric or mixed cells.
+        
+        >>> Calc('row[0] * 2').block([['1'], ['1.5']])
+        [2, 3.0]
+        >>> Calc('row[0] * row[0] // 2').block([[str(2 ** 40)], ['3']])
+        [604462909807314587353088L, 4]
+        """
+        if numpy is not None and self.columns and rows:
+            arrays = [_column_array([row[i] for row in rows]) for i in self.columns]
+            if not any(array is None for array in arrays):
+                try:
+                    with numpy.errstate(divide='raise', over='raise', invalid='raise'):
+                        values = self.cells(*arrays)
+                        if isinstance(values, numpy.ndarray) and values.dtype.kind in 'iub' \
+                                and any(array.dtype.kind == 'i' for array in arrays):
+                            floats = self.cells(*[array.astype(numpy.float64) for array in arrays])
+                            if not numpy.array_equal(values, floats):
+                                values = None
+                except (ArithmeticError, TypeError, ValueError):
+                    values = None
+                if isinstance(values, numpy.ndarray) and values.shape == (len(rows),):
+                    return values.tolist()
+        return [self(row) for row in rows]
+
+_calcs = {}
+def compile_calc(expression, header=None):
+    """Compile a calc expression, reusing the result for repeated expressions.
+    
+    >>> compile_calc('row[0] + 1') is compile_calc('row[0] + 1')
+    True
+    """
+    key = (expression, None if header is None else tuple(header))
+    calc = _calcs.get(key)
+    if calc is None:
+        calc = _calcs[key] = Calc(expression, header)
+    return calc
+
+def _calc_blocks(rows, calc, index, block_rows=DEFAULT_BLOCK_ROWS):
+    """Insert the value of calc at index in each row, evaluating it a block of rows at a time."""
+    while True:
+        block = list(itertools.islice(rows, block_rows))
+        if not block:
+            return
+        for row, val in itertools.izip(block, calc.block(block)):
+            row.insert(index, val)
+            yield row
+
+def _addcolumn_process(args):
+    return addcolumn(args.input, args.output, args.index, args.name, args.default, args.calc,
+                     args.columnar, args.block_rows)
 
 def _addcolumn_args(parser):
     parser.add_argument('input', metavar="INPUT_CSV", help='A csv file to read from')
@@ -188,11 +1080,17 @@ def _addcolumn_args(parser):
     parser.add_argument('--name', '-n', help='The name of the column to add (none by default)', required=False)
     parser.add_argument('--default', '-d', help='The default cell value', required=False)
     parser.add_argument('--calc', '-c', help='The body of a lambda expression that can calculate values based on the current row')
+    parser.add_argument('--columnar', action='store_true', help='Evaluate --calc over blocks of rows, with NumPy if available')
+    parser.add_argument('--block-rows', type=int, default=DEFAULT_BLOCK_ROWS, help='Rows per block in columnar mode')
     parser.set_defaults(func=_addcolumn_process)
 
-def addcolumn(input, output, index=None, col_name=None, cell_val=None, calc=None):
+def addcolumn(input, output, index=None, col_name=None, cell_val=None, calc=None,
+              columnar=False, block_rows=DEFAULT_BLOCK_ROWS):
     """Add a column with an optional name and default value at a specific index.
     If a calc function is provided, it will be used to compute the value for each row.
+    calc may also be the text of an expression over row, which is compiled once.
+    With columnar=True such an expression is evaluated over blocks of block_rows
+    rows at a time (see Calc.block).
     
     Prepare the test
     
@@ -225,8 +1123,31 @@ def addcolumn(input, output, index=None, col_name=None, cell_val=None, calc=None
     >>> read_csv('__test2__.csv')
     [['a', 'b', 'c', 'sum'], ['0', '0', '0', '0'], ['1', '2', '3', '6']]
     
+    Test for adding a column calculated in blocks
+    
+    >>> addcolumn('__test__.csv', '__test2__.csv', 0, "d", calc='row[2] - row[0]', columnar=True) # doctest: +ELLIPSIS
+    Adding calculated column "d" at index 0
+    ...
+    >>> read_csv('__test2__.csv')
+    [['d', 'a', 'b', 'c'], ['0', '0', '0', '0'], ['2', '1', '2', '3']]
+    
+    Test that an expression leaves the other cells as they are, with or without blocks
+    
+    >>> make_csv('__test3__.csv', [['a', 'b'], ['007', '1.50']])
+    >>> addcolumn('__test3__.csv', '__test2__.csv', calc='row[1] * 2') # doctest: +ELLIPSIS
+    Adding calculated column "None" at index 2
+    ...
+    >>> read_csv('__test2__.csv')
+    [['a', 'b', 'bb'], ['007', '1.50', '3.0']]
+    >>> addcolumn('__test3__.csv', '__test2__.csv', calc='row[1] * 2', columnar=True) # doctest: +ELLIPSIS
+    Adding calculated column "None" at index 2
+    ...
+    >>> read_csv('__test2__.csv')
+    [['a', 'b', 'bb'], ['007', '1.50', '3.0']]
+    
     Clean up
     
+    >>> os.remove('__test3__.csv')
     >>> os.remove('__test2__.csv')
     >>> os.remove('__test__.csv')
     """
@@ -241,6 +1162,9 @@ def addcolumn(input, output, index=None, col_name=None, cell_val=None, calc=None
         if index is None:
             index = len(header)
         
+        if isinstance(calc, basestring):
+            calc = compile_calc(calc, header)
+        
         # what goes in the cells?
         if cell_val is None:
             cell_val = ''
@@ -254,11 +1178,19 @@ def addcolumn(input, output, index=None, col_name=None, cell_val=None, calc=None
         else:
             print 'Adding calculated column "%s" at index %d' %(col_name, index)
         
+        if columnar and calc is not None:
+            if not isinstance(calc, Calc):
+                raise Exception("Columnar mode needs calc as an expression")
+            header.insert(index, col_name if col_name is not None else calc(header))
+            write_csv(_calc_blocks(reader, calc, index, block_rows), output, header=header)
+            return
+        
         def generator(rowNum, row):
             if rowNum == 0:
                 # it is the header
                 if calc is not None and col_name is None:
-                    _convert_numbers(row)
+                    if not isinstance(calc, Calc):
+                        _convert_numbers(row)
                     val = calc(row)
                 else:
                     val = col_name
@@ -266,14 +1198,16 @@ def addcolumn(input, output, index=None, col_name=None, cell_val=None, calc=None
                 row.insert(index, val)
             else:
                 if calc is not None:
-                    _convert_numbers(row)
+                    # a compiled expression converts the cells it uses itself
+                    if not isinstance(calc, Calc):
+                        _convert_numbers(row)
                     val = calc(row)
                 else:
                     val = cell_val
                 row.insert(index, val)
             return row
         
-        write_csv(reader, output, header=header, generator=generator)
+        _write_rows(input, reader, output, header=header, generator=generator)
 
 
 def _dropcolumn_process(args):
@@ -344,7 +1278,7 @@ def dropcolumn(input, output, index=None, col_name=None):
             row.pop(index)
             return row
         
-        write_csv(reader, output, header=header, generator=generator)
+        _write_rows(input, reader, output, header=header, generator=generator)
 
 def _rename_process(args):
     return rename(args.input, args.output, args.to, index=args.index, col_name=args.name)
@@ -420,7 +1354,7 @@ def rename(input, output, to_name, index=None, col_name=None):
                 
             return row
         
-        write_csv(reader, output, header=header, generator=generator)
+        _write_rows(input, reader, output, header=header, generator=generator)
 
         
 def _position_process(args):
@@ -495,7 +1429,7 @@ def position(input, output, to_index, index=None, col_name=None):
                 
             return row
         
-        write_csv(reader, output, header=header, generator=generator)
+        _write_rows(input, reader, output, header=header, generator=generator)
         
 def _merge_process(args):
     return merge(args.left, args.right, args.output, args.stop_shorter)
@@ -567,6 +1501,453 @@ def merge(left, right, output, stop_shorter=False):
             
         write_csv(iterator, output, generator=generator)
 
+DEFAULT_MEMORY_BYTES = 256 * 1024 * 1024
+MERGE_FAN_IN = 64
+# a table parsed into a dict of row lists takes up about this many times its size on disk
+HASH_TABLE_FACTOR = 4
+
+def _row_bytes(row):
+    """Roughly how much memory a parsed row takes up."""
+    return 64 + sum(48 + len(value) for value in row)
+
+def _pad(row, length):
+    if len(row) < length:
+        return row + [''] * (length - len(row))
+    return row
+
+def _write_run(rows, directory):
+    handle, filename = tempfile.mkstemp(suffix='.csv', dir=directory)
+    with os.fdopen(handle, 'wb') as outfile:
+        csv.writer(outfile).writerows(rows)
+    return filename
+
+def _merge_runs(runs, key, reverse=False):
+    """Merge sorted csv files into one sorted stream of rows, keeping equal keys in run order."""
+    def keyed(n, filename):
+        with open(filename, 'rb') as infile:
+            for i, row in enumerate(csv.reader(infile)):
+                k = key(row)
+                yield _Descending(k) if reverse else k, n, i, row
+    
+    for item in heapq.merge(*[keyed(n, run) for n, run in enumerate(runs)]):
+        yield item[3]
+
+def external_sort(rows, key, memory_bytes=DEFAULT_MEMORY_BYTES, reverse=False, unique=False):
+    """Yield the rows stably sorted by key, holding about memory_bytes of them at
+    a time. Beyond that, sorted runs are spilled to temporary files and merged,
+    MERGE_FAN_IN files at a time. With unique=True only the first row with each
+    key is kept, dropping duplicates from each run before it is spilled.
+    
+    >>> rows = [['b', '1'], ['a', '2'], ['b', '0'], ['a', '1']]
+    >>> list(external_sort(iter(rows), lambda row: row[0], memory_bytes=0))
+    [['a', '2'], ['a', '1'], ['b', '1'], ['b', '0']]
+    >>> list(external_sort(iter(rows), lambda row: row[0], memory_bytes=0, reverse=True, unique=True))
+    [['b', '1'], ['a', '2']]
+    """
+    directory = None
+    try:
+        runs = []
+        run = []
+        size = 0
+        for row in rows:
+            run.append(row)
+            size += _row_bytes(row)
+            if size > memory_bytes:
+                if directory is None:
+                    directory = tempfile.mkdtemp(prefix='csvop')
+                run.sort(key=key, reverse=reverse)
+                if unique:
+                    run = _unique(run, key)
+                runs.append(_write_run(run, directory))
+                run = []
+                size = 0
+        
+        run.sort(key=key, reverse=reverse)
+        if unique:
+            run = _unique(run, key)
+        if not runs:
+            for row in run:
+                yield row
+            return
+        runs.append(_write_run(run, directory))
+        run = None
+        
+        while len(runs) > MERGE_FAN_IN:
+            merged = []
+            for i in range(0, len(runs), MERGE_FAN_IN):
+                merged.append(_write_run(_merge_runs(runs[i:i + MERGE_FAN_IN], key, reverse), directory))
+                for filename in runs[i:i + MERGE_FAN_IN]:
+                    os.remove(filename)
+            runs = merged
+        
+        rows = _merge_runs(runs, key, reverse)
+        if unique:
+            rows = _unique(rows, key)
+        for row in rows:
+            yield row
+    finally:
+        if directory is not None:
+            shutil.rmtree(directory, ignore_errors=True)
+
+def _hash_join(build, probe, build_key, probe_key, pair, keep_build, keep_probe):
+    """Join by looking the probe rows up in a table of the build rows.
+    pair(build_row, probe_row) makes an output row, with None for a missing side."""
+    table = OrderedDict()
+    for row in build:
+        table.setdefault(build_key(row), []).append(row)
+    
+    matched = set()
+    for row in probe:
+        key = probe_key(row)
+        rows = table.get(key)
+        if rows:
+            if keep_build:
+                matched.add(key)
+            for other in rows:
+                yield pair(other, row)
+        elif keep_probe:
+            yield pair(None, row)
+    
+    if keep_build:
+        for key, rows in table.iteritems():
+            if key not in matched:
+                for other in rows:
+                    yield pair(other, None)
+
+def _merge_join(left, right, left_key, right_key, pair, keep_left, keep_right):
+    """Join two streams of rows sorted by key, holding one key's worth of right rows at a time."""
+    left = iter(left)
+    right = iter(right)
+    l = next(left, None)
+    r = next(right, None)
+    while l is not None and r is not None:
+        lk = left_key(l)
+        rk = right_key(r)
+        if lk < rk:
+            if keep_left:
+                yield pair(l, None)
+            l = next(left, None)
+        elif rk < lk:
+            if keep_right:
+                yield pair(None, r)
+            r = next(right, None)
+        else:
+            group = []
+            while r is not None and right_key(r) == lk:
+                group.append(r)
+                r = next(right, None)
+            while l is not None and left_key(l) == lk:
+                for other in group:
+                    yield pair(l, other)
+                l = next(left, None)
+    
+    while keep_left and l is not None:
+        yield pair(l, None)
+        l = next(left, None)
+    while keep_right and r is not None:
+        yield pair(None, r)
+        r = next(right, None)
+
+def _key_columns(header, names, filename):
+    for name in names:
+        if name not in header:
+            raise Exception('No column "%s" in %s' %(name, filename))
+    return [header.index(name) for name in names]
+
+JOIN_TYPES = ['inner', 'left', 'right', 'outer']
+
+def _join_process(args):
+    right_on = None if args.right_on is None else args.right_on.split(',')
+    return join(args.left, args.right, args.output, args.on.split(','), right_on, args.how,
+                args.memory * 1024 * 1024)
+
+def _join_args(parser):
+    parser.add_argument('left', metavar="LEFT_INPUT_CSV", help='The left input csv table')
+    parser.add_argument('right', metavar="RIGHT_INPUT_CSV", help='The right input csv table')
+    parser.add_argument('output', metavar="OUTPUT_CSV", help='A csv file to write to')
+    parser.add_argument('--on', required=True, help='The key columns of the left table, separated by commas')
+    parser.add_argument('--right-on', help='The key columns of the right table (the same as --on by default)')
+    parser.add_argument('--how', choices=JOIN_TYPES, default='inner', help='The kind of join (default inner)')
+    parser.add_argument('--memory', type=int, default=DEFAULT_MEMORY_BYTES // (1024 * 1024),
+                        help='How many MB of rows to hold in memory (default %d)' %(DEFAULT_MEMORY_BYTES // (1024 * 1024)))
+    parser.set_defaults(func=_join_process)
+
+def join(left, right, output, on, right_on=None, how='inner', memory_bytes=DEFAULT_MEMORY_BYTES):
+    """Join two tables on the values of their key columns.
+    The output has the left columns followed by the right ones other than the key.
+    
+    how is one of inner, left, right or outer; the outer sides keep their
+    unmatched rows, with empty cells for the other table. If the smaller table
+    fits in memory_bytes it is loaded into a hash table and the output follows
+    the order of the other; if not, both tables are sorted by key using
+    temporary files and merged, and the output is in key order.
+    
+    Prepare the test
+    
+    >>> always_confirm(True)
+    >>> make_csv('__test__.csv', [['name', 'city'], ['ann', 'ny'], ['bob', 'sf'], ['cat', 'ny']])
+    >>> make_csv('__test2__.csv', [['code', 'state'], ['ny', 'NY'], ['la', 'CA']])
+    
+    Test for an inner join by hash table
+    
+    >>> join('__test__.csv', '__test2__.csv', '__test3__.csv', 'city', 'code') # doctest: +ELLIPSIS
+    Inner join on city with a hash table of __test2__.csv
+    ...
+    >>> read_csv('__test3__.csv')
+    [['name', 'city', 'state'], ['ann', 'ny', 'NY'], ['cat', 'ny', 'NY']]
+    
+    Test for a left join
+    
+    >>> join('__test__.csv', '__test2__.csv', '__test3__.csv', 'city', 'code', how='left') # doctest: +ELLIPSIS
+    Left join ...
+    >>> read_csv('__test3__.csv')
+    [['name', 'city', 'state'], ['ann', 'ny', 'NY'], ['bob', 'sf', ''], ['cat', 'ny', 'NY']]
+    
+    Test for an outer join by sorting
+    
+    >>> join('__test__.csv', '__test2__.csv', '__test3__.csv', 'city', 'code', how='outer', memory_bytes=0) # doctest: +ELLIPSIS
+    Outer join on city by sorting both tables
+    ...
+    >>> read_csv('__test3__.csv')
+    [['name', 'city', 'state'], ['', 'la', 'CA'], ['ann', 'ny', 'NY'], ['cat', 'ny', 'NY'], ['bob', 'sf', '']]
+    
+    Test for invalid arguments
+    
+    >>> join('__test__.csv', '__test2__.csv', '__test3__.csv', 'city') # doctest: +ELLIPSIS
+    Traceback (most recent call last):
+        ...
+    Exception: No column "city" in __test2__.csv
+    
+    Clean up
+    
+    >>> os.remove('__test3__.csv')
+    >>> os.remove('__test2__.csv')
+    >>> os.remove('__test__.csv')
+    """
+    if how not in JOIN_TYPES:
+        raise Exception('Unknown join type "%s"' %(how))
+    
+    on = [on] if isinstance(on, basestring) else list(on)
+    if right_on is None:
+        right_on = on
+    right_on = [right_on] if isinstance(right_on, basestring) else list(right_on)
+    if len(on) != len(right_on):
+        raise Exception("on and right_on must name the same number of columns")
+    
+    with open(left, 'rbU') as leftfile, open(right, 'rbU') as rightfile:
+        leftReader = csv.reader(leftfile)
+        rightReader = csv.reader(rightfile)
+        
+        leftHeader = leftReader.next()
+        rightHeader = rightReader.next()
+        
+        leftKeys = _key_columns(leftHeader, on, left)
+        rightKeys = _key_columns(rightHeader, right_on, right)
+        keep = [i for i in range(len(rightHeader)) if i not in rightKeys]
+        
+        leftRows = (_pad(row, len(leftHeader)) for row in leftReader)
+        rightRows = (_pad(row, len(rightHeader)) for row in rightReader)
+        leftKey = lambda row: tuple(row[i] for i in leftKeys)
+        rightKey = lambda row: tuple(row[i] for i in rightKeys)
+        
+        def pair(leftRow, rightRow):
+            if leftRow is None:
+                # fill in the key from the right
+                leftRow = [''] * len(leftHeader)
+                for i, j in zip(leftKeys, rightKeys):
+                    leftRow[i] = rightRow[j]
+            if rightRow is None:
+                return leftRow + [''] * len(keep)
+            return leftRow + [rightRow[i] for i in keep]
+        
+        keepLeft = how in ('left', 'outer')
+        keepRight = how in ('right', 'outer')
+        leftSize = os.path.getsize(left)
+        rightSize = os.path.getsize(right)
+        
+        if min(leftSize, rightSize) * HASH_TABLE_FACTOR <= memory_bytes:
+            if rightSize <= leftSize:
+                print '%s join on %s with a hash table of %s' %(how.capitalize(), ', '.join(on), right)
+                rows = _hash_join(rightRows, leftRows, rightKey, leftKey,
+                                  lambda r, l: pair(l, r), keepRight, keepLeft)
+            else:
+                print '%s join on %s with a hash table of %s' %(how.capitalize(), ', '.join(on), left)
+                rows = _hash_join(leftRows, rightRows, leftKey, rightKey, pair, keepLeft, keepRight)
+        else:
+            print '%s join on %s by sorting both tables' %(how.capitalize(), ', '.join(on))
+            rows = _merge_join(external_sort(leftRows, leftKey, memory_bytes // 2),
+                               external_sort(rightRows, rightKey, memory_bytes // 2),
+                               leftKey, rightKey, pair, keepLeft, keepRight)
+        
+        write_csv(rows, output, header=leftHeader + [rightHeader[i] for i in keep])
+
+class _Descending:
+    """Wraps a sort key so that heapq.merge sees it in reverse order."""
+    
+    def __init__(self, value):
+        self.value = value
+    
+    def __eq__(self, other):
+        return self.value == other.value
+    
+    def __ne__(self, other):
+        return self.value != other.value
+    
+    def __lt__(self, other):
+        return other.value < self.value
+    
+    def __gt__(self, other):
+        return other.value > self.value
+
+def _unique(rows, key):
+    """Drop each row whose key is the same as the one before it."""
+    last = marker = object()
+    for row in rows:
+        k = key(row)
+        if last is marker or k != last:
+            yield row
+        last = k
+
+def _int_key(value):
+    try:
+        return int(value)
+    except ValueError:
+        return float(value)
+
+_KEY_TYPES = {'int': _int_key, 'float': float, 'date': parse_date, 'string': str}
+
+def _sort_key(header, keys, filename):
+    """Build a key function from specs of the form NAME or NAME:TYPE, inferring
+    any type left out. Each cell becomes (1, value), or (0, None) if it is not of
+    its column's type, so such cells sort first without being compared to values.
+    
+    >>> key, specs = _sort_key(['d'], ['d:date'], None)
+    >>> key(['']), key(['2019-01-02'])
+    (((0, None),), ((1, datetime.datetime(2019, 1, 2, 0, 0)),))
+    """
+    specs = [key.rsplit(':', 1) if key.rsplit(':', 1)[-1] in _KEY_TYPES else [key, None] for key in keys]
+    if any(kind is None for name, kind in specs):
+        inferred = dict(infer_types(filename))
+        specs = [[name, kind or inferred.get(name, 'string')] for name, kind in specs]
+    
+    indices = _key_columns(header, [name for name, kind in specs], filename)
+    converters = []
+    for name, kind in specs:
+        convert = _KEY_TYPES[kind]
+        
+        def converter(value, convert=convert):
+            try:
+                value = convert(value)
+            except ValueError:
+                value = None
+            return (0, None) if value is None else (1, value)
+        converters.append(converter)
+    
+    def key(row):
+        return tuple(convert(row[i]) for i, convert in zip(indices, converters))
+    return key, specs
+
+def _sort_process(args):
+    return sort(args.input, args.output, args.key, args.reverse, args.unique, args.memory * 1024 * 1024)
+
+def _sort_args(parser):
+    parser.add_argument('input', metavar="INPUT_CSV", help='A csv file to read from')
+    parser.add_argument('output', metavar="OUTPUT_CSV", help='A csv file to write to')
+    parser.add_argument('--key', '-k', action='append', required=True,
+                        help='A column to sort by, as NAME or NAME:TYPE with TYPE one of int, float, date or string '
+                             '(inferred by default); repeat for more columns')
+    parser.add_argument('--reverse', '-r', action='store_true', help='Sort in descending order')
+    parser.add_argument('--unique', '-u', action='store_true', help='Keep only the first row with each key')
+    parser.add_argument('--memory', type=int, default=DEFAULT_MEMORY_BYTES // (1024 * 1024),
+                        help='How many MB of rows to hold in memory (default %d)' %(DEFAULT_MEMORY_BYTES // (1024 * 1024)))
+    parser.set_defaults(func=_sort_process)
+
+def sort(input, output, keys, reverse=False, unique=False, memory_bytes=DEFAULT_MEMORY_BYTES):
+    """Sort a table by one or more key columns, given as NAME or NAME:TYPE.
+    Types are int, float, date or string, and are inferred when left out.
+    The sort is stable, and with unique=True only the first row with each key
+    is kept. Tables larger than memory_bytes are sorted in runs which are
+    spilled to temporary files and merged.
+    
+    Prepare the test
+    
+    >>> always_confirm(True)
+    >>> make_csv('__test__.csv', [['n', 's'], [10, 'b'], [9, 'a'], [10, 'a'], [9, 'c']])
+    
+    Test sorting by typed keys
+    
+    >>> sort('__test__.csv', '__test2__.csv', ['n', 's']) # doctest: +ELLIPSIS
+    Sorting by n (int), s (string)
+    ...
+    >>> read_csv('__test2__.csv')
+    [['n', 's'], ['9', 'a'], ['9', 'c'], ['10', 'a'], ['10', 'b']]
+    
+    Test sorting dates with a blank cell
+    
+    >>> make_csv('__test3__.csv', [['d'], ['2019-01-02'], [''], ['2019-01-01']])
+    >>> sort('__test3__.csv', '__test2__.csv', ['d:date']) # doctest: +ELLIPSIS
+    Sorting by d (date)
+    ...
+    >>> read_csv('__test2__.csv')
+    [['d'], [''], ['2019-01-01'], ['2019-01-02']]
+    >>> os.remove('__test3__.csv')
+    
+    Test sorting in reverse in runs, keeping the first row of each key
+    
+    >>> sort('__test__.csv', '__test2__.csv', ['n:int'], reverse=True, unique=True, memory_bytes=0) # doctest: +ELLIPSIS
+    Sorting by n (int)
+    ...
+    >>> read_csv('__test2__.csv')
+    [['n', 's'], ['10', 'b'], ['9', 'a']]
+    
+    Clean up
+    
+    >>> os.remove('__test2__.csv')
+    >>> os.remove('__test__.csv')
+    """
+    with open(input, 'rbU') as infile:
+        reader = csv.reader(infile)
+        
+        header = reader.next()
+        
+        key, specs = _sort_key(header, keys, input)
+        
+        print 'Sorting by %s' %(', '.join('%s (%s)' %(name, kind) for name, kind in specs))
+        
+        rows = (_pad(row, len(header)) for row in reader)
+        write_csv(external_sort(rows, key, memory_bytes, reverse, unique), output, header=header)
+
+def _dedup_process(args):
+    return dedup(args.input, args.output, args.key, args.memory * 1024 * 1024)
+
+def _dedup_args(parser):
+    parser.add_argument('input', metavar="INPUT_CSV", help='A csv file to read from')
+    parser.add_argument('output', metavar="OUTPUT_CSV", help='A csv file to write to')
+    parser.add_argument('--key', '-k', action='append',
+                        help='A column which makes up the key, as for sort (all columns by default)')
+    parser.add_argument('--memory', type=int, default=DEFAULT_MEMORY_BYTES // (1024 * 1024),
+                        help='How many MB of rows to hold in memory (default %d)' %(DEFAULT_MEMORY_BYTES // (1024 * 1024)))
+    parser.set_defaults(func=_dedup_process)
+
+def dedup(input, output, keys=None, memory_bytes=DEFAULT_MEMORY_BYTES):
+    """Drop rows with the same key as an earlier row, comparing all of the
+    columns as strings by default. This is a unique sort, so the output is in
+    key order.
+    
+    >>> always_confirm(True)
+    >>> make_csv('__test__.csv', [['a', 'b'], [2, 1], [1, 1], [2, 1], [1, 2]])
+    >>> dedup('__test__.csv', '__test2__.csv') # doctest: +ELLIPSIS
+    Sorting by a (string), b (string)
+    ...
+    >>> read_csv('__test2__.csv')
+    [['a', 'b'], ['1', '1'], ['1', '2'], ['2', '1']]
+    >>> os.remove('__test2__.csv')
+    >>> os.remove('__test__.csv')
+    """
+    if keys is None:
+        keys = ['%s:string' %(name) for name in csv_header(input)]
+    return sort(input, output, keys, unique=True, memory_bytes=memory_bytes)
+
 def _select_process(args):
     return select(args.input, args.output, args.from_, args.to)
 
@@ -628,9 +2009,441 @@ def select(input, output, fromIndex=None, toIndex=None):
         def generator(rowNum, row):
             return row[fromIndex:toIndex]
             
-        write_csv(reader, output, header=header, generator=generator)
+        _write_rows(input, reader, output, header=header, generator=generator)
+
+        
+
+def _filter_process(args):
+    return filter_rows(args.input, args.output, args.where)
+
+def _filter_args(parser):
+    parser.add_argument('input', metavar="INPUT_CSV", help='A csv file to read from')
+    parser.add_argument('output', metavar="OUTPUT_CSV", help='A csv file to write to')
+    parser.add_argument('--where', '-w', required=True,
+                        help='An expression over the columns, by name or as row[N], which is true for the rows to keep')
+    parser.set_defaults(func=_filter_process)
 
+def filter_rows(input, output, where):
+    """Keep only the rows for which the expression where is true.
+    Columns are referred to by name, as row['name'] or as row[N]; only the
+    cells the expression uses are converted to numbers. where may also be a
+    function of the row.
+    
+    Prepare the test
+    
+    >>> always_confirm(True)
+    >>> make_csv('__test__.csv', [['city', 'age'], ['NY', 25], ['LA', 40], ['NY', 52]])
+    
+    Test filtering on named columns
+    
+    >>> filter_rows('__test__.csv', '__test2__.csv', 'city == "NY" and age > 30') # doctest: +ELLIPSIS
+    Keeping rows where city == "NY" and age > 30
+    ...
+    >>> read_csv('__test2__.csv')
+    [['city', 'age'], ['NY', '52']]
+    
+    Test for unknown columns
+    
+    >>> filter_rows('__test__.csv', '__test2__.csv', 'row["name"] == "x"')
+    Traceback (most recent call last):
+        ...
+    Exception: Unknown column "name"
+    
+    Clean up
+    
+    >>> os.remove('__test2__.csv')
+    >>> os.remove('__test__.csv')
+    """
+    with open(input, 'rbU') as infile:
+        reader = csv.reader(infile)
+        
+        header = reader.next()
         
+        if isinstance(where, basestring):
+            where = compile_calc(where, header)
+            print 'Keeping rows where %s' %(where.expression)
+        else:
+            print 'Keeping rows where %s is true' %(where.__name__)
+        
+        def generator(rowNum, row):
+            if rowNum == 0 or where(row):
+                return row
+            return None
+        
+        _write_rows(input, reader, output, header=header, generator=generator)
+
+def _index_process(args):
+    index = build_row_index(args.input)
+    print 'Indexed %d rows of %s' %(index.rows, args.input)
+    index.close()
+
+def _index_args(parser):
+    parser.add_argument('input', metavar="INPUT_CSV", help='A csv file to index')
+    parser.set_defaults(func=_index_process)
+
+def _head_process(args):
+    return head(args.input, args.output, args.count)
+
+def _tail_process(args):
+    return tail(args.input, args.output, args.count)
+
+def _head_args(parser):
+    parser.add_argument('input', metavar="INPUT_CSV", help='A csv file to read from')
+    parser.add_argument('output', metavar="OUTPUT_CSV", help='A csv file to write to')
+    parser.add_argument('--count', '-n', type=int, default=10, help='The number of rows to take (default 10)')
+    parser.set_defaults(func=_head_process)
+
+def _tail_args(parser):
+    parser.add_argument('input', metavar="INPUT_CSV", help='A csv file to read from')
+    parser.add_argument('output', metavar="OUTPUT_CSV", help='A csv file to write to')
+    parser.add_argument('--count', '-n', type=int, default=10, help='The number of rows to take (default 10)')
+    parser.set_defaults(func=_tail_process)
+
+def head(input, output, count=10):
+    """Copy the header and the first count rows of a table.
+    
+    >>> always_confirm(True)
+    >>> make_csv('__test__.csv', [['a'], [0], [1], [2]])
+    >>> head('__test__.csv', '__test2__.csv', 2) # doctest: +ELLIPSIS
+    Selecting rows 0 through 1
+    ...
+    >>> read_csv('__test2__.csv')
+    [['a'], ['0'], ['1']]
+    >>> os.remove('__test2__.csv')
+    >>> os.remove('__test__.csv')
+    """
+    with open(input, 'rbU') as infile:
+        reader = csv.reader(infile)
+        
+        header = reader.next()
+        
+        print 'Selecting rows 0 through %d' %(count - 1)
+        
+        write_csv(itertools.islice(reader, count), output, header=header)
+
+def tail(input, output, count=10):
+    """Copy the header and the last count rows of a table, using its row index.
+    
+    >>> always_confirm(True)
+    >>> make_csv('__test__.csv', [['a'], [0], [1], [2]])
+    >>> tail('__test__.csv', '__test2__.csv', 2) # doctest: +ELLIPSIS
+    Selecting rows 1 through 2
+    ...
+    >>> read_csv('__test2__.csv')
+    [['a'], ['1'], ['2']]
+    >>> os.remove('__test__.csv.csvidx')
+    >>> os.remove('__test2__.csv')
+    >>> os.remove('__test__.csv')
+    """
+    index = row_index(input)
+    try:
+        rows = index.rows - 1
+        return slice_rows(input, output, max(rows - count, 0), rows, index)
+    finally:
+        index.close()
+
+def _slice_process(args):
+    return slice_rows(args.input, args.output, args.from_, None if args.to is None else args.to + 1)
+
+def _slice_args(parser):
+    parser.add_argument('input', metavar="INPUT_CSV", help='A csv file to read from')
+    parser.add_argument('output', metavar="OUTPUT_CSV", help='A csv file to write to')
+    parser.add_argument('--from', dest="from_", metavar="FROM_ROW", type=int, help='The row to start with (default 0)')
+    parser.add_argument('--to', metavar="TO_ROW", type=int, help='The row to end with, inclusive (default last)')
+    parser.set_defaults(func=_slice_process)
+
+def slice_rows(input, output, start=None, stop=None, index=None):
+    """Copy the header and the rows from start up to stop, counting from the
+    first row after the header, seeking straight to them with the row index.
+    
+    >>> always_confirm(True)
+    >>> make_csv('__test__.csv', [['a'], [0], [1], [2], [3]])
+    >>> slice_rows('__test__.csv', '__test2__.csv', 1, 3) # doctest: +ELLIPSIS
+    Selecting rows 1 through 2
+    ...
+    >>> read_csv('__test2__.csv')
+    [['a'], ['1'], ['2']]
+    >>> os.remove('__test__.csv.csvidx')
+    >>> os.remove('__test2__.csv')
+    >>> os.remove('__test__.csv')
+    """
+    own_index = index is None
+    if own_index:
+        index = row_index(input)
+    try:
+        rows = index.rows - 1
+        start = 0 if start is None else min(start, rows)
+        stop = rows if stop is None else min(stop, rows)
+        
+        print 'Selecting rows %d through %d' %(start, stop - 1)
+        
+        header = index.read(0, 1)[0]
+        write_csv(index.read(start + 1, max(start, stop) + 1), output, header=header)
+    finally:
+        if own_index:
+            index.close()
+
+def _sample_process(args):
+    return sample(args.input, args.output, args.count, args.seed)
+
+def _sample_args(parser):
+    parser.add_argument('input', metavar="INPUT_CSV", help='A csv file to read from')
+    parser.add_argument('output', metavar="OUTPUT_CSV", help='A csv file to write to')
+    parser.add_argument('--count', '-n', type=int, default=10, help='The number of rows to take (default 10)')
+    parser.add_argument('--seed', type=int, help='Seed the random choice of rows')
+    parser.set_defaults(func=_sample_process)
+
+def sample(input, output, count=10, seed=None):
+    """Copy the header and count rows chosen uniformly at random, in file order,
+    reading only those rows by way of the row index.
+    
+    >>> always_confirm(True)
+    >>> make_csv('__test__.csv', [['a']] + [[i] for i in range(100)])
+    >>> sample('__test__.csv', '__test2__.csv', 5, seed=1) # doctest: +ELLIPSIS
+    Sampling 5 of 100 rows
+    ...
+    >>> rows = read_csv('__test2__.csv')
+    >>> rows[0], len(rows), rows[1:] == sorted(rows[1:], key=lambda row: int(row[0]))
+    (['a'], 6, True)
+    >>> os.remove('__test__.csv.csvidx')
+    >>> os.remove('__test2__.csv')
+    >>> os.remove('__test__.csv')
+    """
+    index = row_index(input)
+    try:
+        rows = index.rows - 1
+        count = min(count, rows)
+        
+        print 'Sampling %d of %d rows' %(count, rows)
+        
+        chosen = sorted(random.Random(seed).sample(xrange(1, rows + 1), count))
+        write_csv(index.get(chosen), output, header=index.read(0, 1)[0])
+    finally:
+        index.close()
+
+def _addcolumn_stage(header, index=None, col_name=None, cell_val=None, calc=None):
+    if index is None:
+        index = len(header)
+    if cell_val is None:
+        cell_val = ''
+    if col_name is None and calc is None:
+        col_name = cell_val
+    if isinstance(calc, basestring):
+        calc = compile_calc(calc, header)
+    elif calc is not None and not isinstance(calc, Calc):
+        function = calc
+        calc = lambda row: function(_convert_numbers(list(row)))
+    
+    if col_name is None:
+        col_name = calc(header)
+    header.insert(index, col_name)
+    
+    if calc is None:
+        def stage(row):
+            row.insert(index, cell_val)
+            return row
+    else:
+        def stage(row):
+            row.insert(index, calc(row))
+            return row
+    return stage
+
+def _dropcolumn_stage(header, index=None, col_name=None):
+    if index is None and col_name is None:
+        raise Exception("One of index and col_name must be specified")
+    col_name, index = col_reference(header, col_name, index)
+    header.pop(index)
+    
+    def stage(row):
+        row.pop(index)
+        return row
+    return stage
+
+def _rename_stage(header, to_name, index=None, col_name=None):
+    if index is None and col_name is None:
+        raise Exception("One of index and col_name must be specified")
+    col_name, index = col_reference(header, col_name, index)
+    header[index] = to_name
+    # only the header changes
+    return None
+
+def _position_stage(header, to_index, index=None, col_name=None):
+    if index is None and col_name is None:
+        raise Exception("One of index and col_name must be specified")
+    col_name, index = col_reference(header, col_name, index)
+    header.insert(to_index, header.pop(index))
+    
+    def stage(row):
+        row.insert(to_index, row.pop(index))
+        return row
+    return stage
+
+def _filter_stage(header, where):
+    if isinstance(where, basestring):
+        where = compile_calc(where, header)
+    
+    def stage(row):
+        return row if where(row) else None
+    return stage
+
+def _select_stage(header, fromIndex=None, toIndex=None):
+    fromIndex = 0 if fromIndex is None else fromIndex
+    toIndex = len(header) if toIndex is None else toIndex
+    header[:] = header[fromIndex:toIndex]
+    
+    def stage(row):
+        return row[fromIndex:toIndex]
+    return stage
+
+_PIPELINE_STAGES = {
+    'addcolumn': _addcolumn_stage,
+    'dropcolumn': _dropcolumn_stage,
+    'rename': _rename_stage,
+    'position': _position_stage,
+    'select': _select_stage,
+    'filter': _filter_stage,
+}
+
+def _pipeline_step(text):
+    """Parse a command line pipeline step of the form command:key=value;...
+    
+    >>> _pipeline_step('dropcolumn:name=b')
+    ('dropcolumn', {'col_name': 'b'})
+    >>> sorted(_pipeline_step('position:index=2;to=0')[1].items())
+    [('index', 2), ('to_index', 0)]
+    >>> _pipeline_step('select')
+    ('select', {})
+    
+    Expressions are compiled later, against the header as it is at that step
+    
+    >>> sorted(_pipeline_step('addcolumn:name=t;calc=price * qty')[1].items())
+    [('calc', 'price * qty'), ('col_name', 't')]
+    """
+    command, _, options = text.partition(':')
+    if command not in _PIPELINE_STAGES:
+        raise Exception('Unknown pipeline command "%s"' %(command))
+    
+    keys = {'name': 'col_name', 'index': 'index', 'default': 'cell_val', 'calc': 'calc',
+            'from': 'fromIndex', 'where': 'where'}
+    if command == 'rename':
+        keys['to'] = 'to_name'
+    elif command == 'position':
+        keys['to'] = 'to_index'
+    elif command == 'select':
+        keys['to'] = 'toIndex'
+    
+    kwargs = {}
+    for option in filter(None, options.split(';')):
+        key, _, value = option.partition('=')
+        if key not in keys:
+            raise Exception('Unknown option "%s" for %s' %(key, command))
+        key = keys[key]
+        if key in ('index', 'to_index', 'fromIndex', 'toIndex'):
+            value = int(value)
+        kwargs[key] = value
+    
+    # select --to is inclusive on the command line
+    if 'toIndex' in kwargs:
+        kwargs['toIndex'] += 1
+    return command, kwargs
+
+def _pipeline_process(args):
+    return pipeline(args.input, args.output, [_pipeline_step(s) for s in args.steps])
+
+def _pipeline_args(parser):
+    parser.add_argument('input', metavar="INPUT_CSV", help='A csv file to read from')
+    parser.add_argument('output', metavar="OUTPUT_CSV", help='A csv file to write to')
+    parser.add_argument('steps', metavar="STEP", nargs='+',
+                        help='An operation such as "dropcolumn:name=b" or "position:index=2;to=0", applied in order')
+    parser.set_defaults(func=_pipeline_process)
+
+def pipeline(input, output, steps):
+    """Apply a sequence of column operations in a single pass over the input.
+    Each step is a (command, kwargs) pair naming one of addcolumn, dropcolumn,
+    rename, position, select or filter (see filter_rows), with the keyword
+    arguments of that function.
+    Column references are resolved once against the header as it looks after
+    the previous steps.
+    
+    Prepare the test
+    
+    >>> always_confirm(True)
+    >>> make_csv('__test__.csv', [['a', 'b', 'c'], [1, 2, 3], [4, 5, 6]])
+    
+    Test chaining several operations
+    
+    >>> pipeline('__test__.csv', '__test2__.csv', [
+    ...     ('dropcolumn', {'col_name': 'b'}),
+    ...     ('rename', {'to_name': 'x', 'col_name': 'a'}),
+    ...     ('addcolumn', {'col_name': 'sum', 'calc': sum}),
+    ...     ('position', {'to_index': 0, 'col_name': 'sum'}),
+    ...     ('select', {'toIndex': 2})]) # doctest: +ELLIPSIS
+    Running 5 steps: dropcolumn, rename, addcolumn, position, select
+    ...
+    >>> read_csv('__test2__.csv')
+    [['sum', 'x'], ['4', '1'], ['10', '4']]
+    
+    Test filtering rows along the way
+    
+    >>> pipeline('__test__.csv', '__test2__.csv', [
+    ...     ('filter', {'where': 'a > 1'}),
+    ...     ('select', {'fromIndex': 2})]) # doctest: +ELLIPSIS
+    Running 2 steps: filter, select
+    ...
+    >>> read_csv('__test2__.csv')
+    [['c'], ['6']]
+    
+    Test an expression over columns named by an earlier step
+    
+    >>> pipeline('__test__.csv', '__test2__.csv', [_pipeline_step('rename:name=a;to=price'),
+    ...     _pipeline_step('addcolumn:name=t;calc=price * c')]) # doctest: +ELLIPSIS
+    Running 2 steps: rename, addcolumn
+    ...
+    >>> read_csv('__test2__.csv')
+    [['price', 'b', 'c', 't'], ['1', '2', '3', '3'], ['4', '5', '6', '24']]
+    
+    Test for unknown commands
+    
+    >>> pipeline('__test__.csv', '__test2__.csv', [('merge', {})])
+    Traceback (most recent call last):
+        ...
+    Exception: Unknown pipeline command "merge"
+    
+    Clean up
+    
+    >>> os.remove('__test2__.csv')
+    >>> os.remove('__test__.csv')
+    """
+    for command, kwargs in steps:
+        if command not in _PIPELINE_STAGES:
+            raise Exception('Unknown pipeline command "%s"' %(command))
+    
+    with open(input, 'rbU') as infile:
+        reader = csv.reader(infile)
+        
+        header = reader.next()
+        
+        # each factory updates the header in place and returns a row function
+        stages = []
+        for command, kwargs in steps:
+            stage = _PIPELINE_STAGES[command](header, **kwargs)
+            if stage is not None:
+                stages.append(stage)
+        
+        print 'Running %d steps: %s' %(len(steps), ', '.join(command for command, kwargs in steps))
+        
+        def generator(rowNum, row):
+            if rowNum == 0:
+                return row
+            for stage in stages:
+                row = stage(row)
+                if row is None:
+                    # filtered out
+                    return None
+            return row
+        
+        _write_rows(input, reader, output, header=header, generator=generator)
+
     
 if __name__ == '__main__':
     import argparse
@@ -638,6 +2451,7 @@ if __name__ == '__main__':
     # create the top-level parser
     parser = argparse.ArgumentParser(description="Perform operations on CSV files")
     parser.add_argument('--yes', action='store_true', help='Answer yes to all prompts')
+    parser.add_argument('--processes', '-p', type=int, default=1, help='Process rows in this many processes (0 for one per core)')
     subparsers = parser.add_subparsers(metavar="COMMAND")
     
     # create the parser for the "addcolumn" command
@@ -660,13 +2474,56 @@ if __name__ == '__main__':
     merge_parser = subparsers.add_parser('merge', help='vertically merge two tables')
     _merge_args(merge_parser)
     
+    # create the parser for the "join" command
+    join_parser = subparsers.add_parser('join', help='join two tables on key columns')
+    _join_args(join_parser)
+    
+    # create the parser for the "sort" command
+    sort_parser = subparsers.add_parser('sort', help='sort a table by key columns')
+    _sort_args(sort_parser)
+    
+    # create the parser for the "dedup" command
+    dedup_parser = subparsers.add_parser('dedup', help='drop rows with repeated keys')
+    _dedup_args(dedup_parser)
+    
     # create the parser for the "select" command
     select_parser = subparsers.add_parser('select', help='select columns from a table, by index')
     _select_args(select_parser)
     
+    # create the parser for the "pipeline" command
+    pipeline_parser = subparsers.add_parser('pipeline', help='apply several column operations in one pass')
+    _pipeline_args(pipeline_parser)
+    
+    # create the parser for the "filter" command
+    filter_parser = subparsers.add_parser('filter', help='keep the rows matching an expression')
+    _filter_args(filter_parser)
+    
+    # create the parser for the "index" command
+    index_parser = subparsers.add_parser('index', help='build the row offset index of a table')
+    _index_args(index_parser)
+    
+    # create the parser for the "head" command
+    head_parser = subparsers.add_parser('head', help='take the first rows of a table')
+    _head_args(head_parser)
+    
+    # create the parser for the "tail" command
+    tail_parser = subparsers.add_parser('tail', help='take the last rows of a table')
+    _tail_args(tail_parser)
+    
+    # create the parser for the "slice" command
+    slice_parser = subparsers.add_parser('slice', help='select rows from a table, by number')
+    _slice_args(slice_parser)
+    
+    # create the parser for the "sample" command
+    sample_parser = subparsers.add_parser('sample', help='take random rows from a table')
+    _sample_args(sample_parser)
+    
     args = parser.parse_args()
     
     if not args.yes:
         always_confirm(False)
     
+    if args.processes != 1:
+        parallel(args.processes or None)
+    
     args.func(args)
@@ -2,27 +2,869 @@
 
 import os
 from os import walk
+import sys
 
 import time
 from datetime import datetime
 import json
+import random
+import itertools
+import fnmatch
+import atexit
+import weakref
+import hashlib
+from collections import OrderedDict
+from contextlib import contextmanager
+import threading
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+import Queue
 import csvop
 
-from elasticsearch import Elasticsearch
+from elasticsearch import Elasticsearch, RoundRobinSelector
 from elasticsearch.helpers import bulk
+from elasticsearch.exceptions import TransportError, ConnectionTimeout
+from elasticsearch.client.utils import _make_path
+from elasticsearch.serializer import JSONSerializer
 
+try:
+    import ujson
+except ImportError:
+    ujson = None
+
+
+# 与es客户端的JSONSerializer一样处理datetime、Decimal、UUID及numpy/pandas类型
+_stdlib_dumps = json.JSONEncoder(separators=(',', ':'), default=JSONSerializer().default).encode
+_PLAIN_TYPES = (basestring, int, long, float, type(None))
+
+
+def _is_plain(data):
+    '''
+    数据是否只由JSON原生类型组成, 只有这样的数据才交给ujson
+    '''
+    if isinstance(data, _PLAIN_TYPES):
+        return True
+    if isinstance(data, dict):
+        return all(isinstance(k, basestring) and _is_plain(v) for k, v in data.iteritems())
+    if isinstance(data, (list, tuple)):
+        return all(_is_plain(v) for v in data)
+    return False
+
+
+def _ujson_dumps(data):
+    if _is_plain(data):
+        return ujson.dumps(data, ensure_ascii=True, escape_forward_slashes=False)
+    return _stdlib_dumps(data)
+
+
+def _same_as_stdlib(dumps):
+    '''
+    检查dumps对常见取值的输出与标准库json完全一致(浮点精度、转义等), 不一致则不使用
+    '''
+    probe = {'f': 0.1 + 0.2, 'e': 1e300, 'i': 2 ** 62, 's': u'\u4e2d"/\n', 'b': True, 'n': None, 'l': [1, 'x']}
+    try:
+        return dumps(probe) == _stdlib_dumps(probe)
+    except Exception:
+        return False
+
+
+_json_dumps = _ujson_dumps if ujson is not None and _same_as_stdlib(_ujson_dumps) else _stdlib_dumps
+
+
+# BufferedWriter默认的刷新阈值: 文档条数、字节数、等待时间(秒), 以及缓冲队列上限
+DEFAULT_BUFFER_DOCS = 500
+DEFAULT_BUFFER_BYTES = 5 * 1024 * 1024
+DEFAULT_FLUSH_INTERVAL = 1.0
+DEFAULT_BUFFER_QUEUE = 10000
+# 推断CSV字段类型时抽样的行数, 及csvop推断类型对应的es字段类型
+DEFAULT_SAMPLE_ROWS = 1000
+ES_FIELD_TYPES = {'int': 'long', 'float': 'double', 'date': 'date', 'string': 'keyword'}
+# 按时间路由时index名称的后缀格式, 如demo-2019.01.31
+TIME_INDEX_FORMATS = {'day': '%Y.%m.%d', 'month': '%Y.%m', 'year': '%Y'}
+# bulk_load结束后force merge的超时时间(秒)
+DEFAULT_FORCE_MERGE_TIMEOUT = 3600
+# 每个节点的连接池大小、请求超时(秒)、失败节点的初始屏蔽时间(秒, 连续失败时指数增长)
+DEFAULT_POOL_SIZE = 10
+DEFAULT_TIMEOUT = 10
+DEFAULT_DEAD_TIMEOUT = 60
+# 开启嗅探时重新获取集群节点列表的间隔(秒)
+DEFAULT_SNIFFER_TIMEOUT = 60
+# bulk请求默认的分批上限: 文档条数、请求体字节数
+DEFAULT_CHUNK_SIZE = 500
+DEFAULT_MAX_CHUNK_BYTES = 10 * 1024 * 1024
+# 统计结果中最多保留的失败条目数, 避免大文件导入时错误列表占满内存
+MAX_REPORTED_ERRORS = 100
+# BulkEncoder缓存的action行上限(按操作类型、index、type区分)
+MAX_CACHED_ACTION_LINES = 1024
+# 被拒绝(429)条目的默认重试次数及退避时间(秒)
+DEFAULT_MAX_RETRIES = 8
+DEFAULT_INITIAL_BACKOFF = 0.5
+DEFAULT_MAX_BACKOFF = 60
+# scanDoc默认每页条数、scroll/point in time的保持时间
+DEFAULT_PAGE_SIZE = 1000
+DEFAULT_SCROLL = '5m'
+# getDocsByIds每个_mget请求的id数、searchMany每个_msearch请求的查询数, 以及并发请求数
+DEFAULT_MGET_SIZE = 1000
+DEFAULT_MSEARCH_SIZE = 100
+DEFAULT_LOOKUP_WORKERS = 4
+# QueryCache默认的最大条目数和过期时间(秒)
+DEFAULT_CACHE_ENTRIES = 1024
+DEFAULT_CACHE_TTL = 60
+
+
+def _to_date(value):
+    '''
+    将csvop.DATE_FORMATS中的日期转换为ES默认可识别的ISO格式
+    '''
+    parsed = csvop.parse_date(value)
+    if parsed is None:
+        return value
+    if parsed.time() == datetime.min.time():
+        return parsed.date().isoformat()
+    return parsed.isoformat()
+
+
+def _converter(field_type):
+    '''
+    返回将CSV单元格转换为对应类型的函数; 空单元格转换为None, 无法转换的值保留原字符串由ES报告错误;
+    带前导零的数字(如编码007)同样保留原字符串, 不丢失前导零
+    '''
+    parse = {'int': int, 'float': float, 'date': _to_date}.get(field_type)
+    if parse is None:
+        return None
+
+    def convert(value):
+        if value == '':
+            return None
+        if field_type != 'date' and csvop.zero_padded(value):
+            return value
+        try:
+            return parse(value)
+        except ValueError:
+            return value
+    return convert
+
+
+def _document_id(row, key_indices):
+    '''
+    由关键列的原始值计算确定的文档id, 重复导入同一行时id不变
+    '''
+    return hashlib.sha1('\x1f'.join(row[i] for i in key_indices)).hexdigest()
+
+
+def _csv_documents(csvfile, types=None, id_columns=None, offset=0, row_number=0, time_column=None):
+    '''
+    逐行读取CSV文件, 第一行是标题, 之后每一行生成一个dict文档
+    :param csvfile: csv文件，包括完整路径
+    :param types: csvop.infer_types的结果, 指定时按类型转换各列的值
+    :param id_columns: 用于计算文档id的列名列表, 为None时id由ES生成
+    :param offset: 开始读取的字节位置, 为0时从标题之后开始
+    :param row_number: offset处已读取的数据行数
+    :param time_column: 按时间路由的列名, 指定时每项另附该列转换前的原始文本
+    :return: 生成器, 每项为(文档id, 文档, (该行结束的字节位置, 行号)), 指定time_column时为(..., 原始文本)
+    '''
+    title = csvop.csv_header(csvfile)
+    key_indices = [title.index(name) for name in id_columns] if id_columns else None
+    time_index = title.index(time_column) if time_column is not None else None
+    converters = [_converter(field_type) for name, field_type in types] if types else []
+    converters = [(i, convert) for i, convert in enumerate(converters) if convert is not None]
+    rows = csvop.iter_csv_offsets(csvfile, offset)
+    if offset == 0:
+        next(rows)
+    for row, end in rows:
+        row_number += 1
+        doc_id = _document_id(row, key_indices) if key_indices else None
+        raw_time = row[time_index] if time_index is not None and time_index < len(row) else None
+        for i, convert in converters:
+            if i < len(row):
+                row[i] = convert(row[i])
+        if time_index is not None:
+            yield doc_id, dict(zip(title, row)), (end, row_number), raw_time
+        else:
+            yield doc_id, dict(zip(title, row)), (end, row_number)
+
+
+class IngestCheckpoint:
+    def __init__(self, path, csvfile):
+        '''
+        CSV导入的断点文件, 记录已确认写入的最后一个批次在CSV中的字节位置和行号;
+        并行写入时批次可能乱序完成, 只有之前的批次都完成后才前移断点
+        :param path: 断点文件路径, 已存在时从中恢复
+        :param csvfile: 导入的csv文件, 与断点文件中记录的不一致时报错
+        '''
+        self.path = path
+        self.csvfile = os.path.abspath(csvfile)
+        self.offset = 0
+        self.row = 0
+        if os.path.exists(path):
+            with open(path) as f:
+                saved = json.load(f)
+            if saved['csvfile'] != self.csvfile:
+                raise ValueError('checkpoint %s belongs to %s' % (path, saved['csvfile']))
+            self.offset = saved['offset']
+            self.row = saved['row']
+        self._done = {}
+        self._next = 0
+        self._lock = threading.Lock()
+
+    def done(self, seq, chunk):
+        '''
+        记录第seq个批次已写入, 前移断点并保存
+        :param chunk: 该批次, 最后一项的第三个元素为(字节位置, 行号)
+        '''
+        with self._lock:
+            self._done[seq] = chunk[-1][2]
+            if self._next not in self._done:
+                return
+            while self._next in self._done:
+                self.offset, self.row = self._done.pop(self._next)
+                self._next += 1
+            self.save()
+
+    def save(self):
+        # 先写临时文件再重命名, 中途崩溃不会留下不完整的断点文件
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump({'csvfile': self.csvfile, 'offset': self.offset, 'row': self.row}, f)
+        os.rename(tmp, self.path)
+
+    def remove(self):
+        '''
+        导入完成后删除断点文件
+        '''
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+class BulkEncoder:
+    def __init__(self, dumps=None):
+        '''
+        bulk请求体编码器, ElasticObj所有bulk写入都经由它序列化;
+        不含_id等逐条字段的action行按(操作, _index, _type)缓存
+        :param dumps: JSON序列化函数, 默认使用标准库json(紧凑格式, 与es客户端一样处理日期等类型);
+                      已安装的ujson输出与之一致时, 对只含JSON原生类型的数据改用ujson
+        '''
+        self.dumps = dumps or _json_dumps
+        self._action_lines = {}
+
+    def action_line(self, action):
+        '''
+        序列化action行, 如{'index': {}}、{'delete': {'_id': 1}}
+        '''
+        op, meta = next(iter(action.items()))
+        if any(key not in ('_index', '_type') for key in meta):
+            return self.dumps(action) + '\n'
+        key = (op, meta.get('_index'), meta.get('_type'))
+        line = self._action_lines.get(key)
+        if line is None:
+            if len(self._action_lines) >= MAX_CACHED_ACTION_LINES:
+                self._action_lines.clear()
+            line = self._action_lines[key] = self.dumps(action) + '\n'
+        return line
+
+    def encode(self, action, source):
+        '''
+        :return: (action_line, source_line), source为None时source_line为空串
+        '''
+        source_line = self.dumps(source) + '\n' if source is not None else ''
+        return self.action_line(action), source_line
+
+    def body(self, chunk):
+        '''
+        将一个批次已序列化的请求行拼接为完整的NDJSON请求体
+        '''
+        return ''.join(line for item in chunk for line in item[:2])
+
+
+bulk_encoder = BulkEncoder()
+
+
+def set_bulk_json(dumps):
+    '''
+    替换bulk请求体使用的JSON序列化函数, 如simplejson.dumps
+    '''
+    bulk_encoder.dumps = dumps
+    bulk_encoder._action_lines.clear()
+
+
+def _serialize_actions(actions):
+    '''
+    将(action, source)序列序列化为bulk请求行
+    :param actions: 可迭代的(action, source)对, source为None时(如delete)只输出action行
+    :return: 生成器, 每项为(action_line, source_line)
+    '''
+    for action, source in actions:
+        yield bulk_encoder.encode(action, source)
+
+
+def _chunk_lines(lines, chunk_size=DEFAULT_CHUNK_SIZE, max_chunk_bytes=DEFAULT_MAX_CHUNK_BYTES,
+                 backpressure=None):
+    '''
+    将已序列化的bulk请求行按条数和字节数切分为批次
+    :param lines: 可迭代的(action_line, source_line), 可附带第三项(如CSV中的位置), 原样保留在批次中
+    :param chunk_size: 每批最多文档条数
+    :param max_chunk_bytes: 每批请求体最大字节数
+    :param backpressure: BulkBackpressure实例, 指定时每批条数取其当前的chunk_size
+    :return: 批次生成器, 每批为[(action_line, source_line), ...]
+    '''
+    chunk = []
+    chunk_bytes = 0
+    for item in lines:
+        if backpressure is not None:
+            chunk_size = backpressure.chunk_size
+        item_bytes = len(item[0]) + len(item[1])
+        if chunk and (len(chunk) >= chunk_size or chunk_bytes + item_bytes > max_chunk_bytes):
+            yield chunk
+            chunk = []
+            chunk_bytes = 0
+        chunk.append(item)
+        chunk_bytes += item_bytes
+    if chunk:
+        yield chunk
+
+
+def _bulk_chunks(actions, chunk_size=DEFAULT_CHUNK_SIZE, max_chunk_bytes=DEFAULT_MAX_CHUNK_BYTES,
+                 backpressure=None):
+    '''
+    将(action, source)序列序列化后按条数和字节数切分为bulk批次, 参数同_chunk_lines
+    '''
+    return _chunk_lines(_serialize_actions(actions), chunk_size, max_chunk_bytes, backpressure)
+
+
+def _dataframe_lines(dataFrame, id_column=None, rows_per_slice=DEFAULT_CHUNK_SIZE):
+    '''
+    将DataFrame分片序列化为bulk请求行: 每片由pandas按列直接编码为NDJSON,
+    不为每行构造dict, 内存占用只与分片大小有关;
+    浮点数按pandas支持的最高精度编码, 保留15位有效数字(repr为17位, 超出部分被舍入)
+    :param dataFrame: 待插入数据集
+    :param id_column: 作为文档_id的列名, 该列仍保留在文档中; 为None时由ES生成_id
+    :param rows_per_slice: 每次序列化的行数
+    :return: 生成器, 每项为(action_line, source_line)
+    '''
+    index_line = bulk_encoder.action_line({'index': {}})
+    for start in range(0, len(dataFrame), rows_per_slice):
+        frame = dataFrame.iloc[start:start + rows_per_slice]
+        sources = frame.to_json(orient='records', lines=True, date_format='iso',
+                                double_precision=15).rstrip('\n').split('\n')
+        if id_column is None:
+            for source in sources:
+                yield index_line, source + '\n'
+        else:
+            for _id, source in zip(frame[id_column].tolist(), sources):
+                yield bulk_encoder.action_line({'index': {'_id': _id}}), source + '\n'
+
+
+def _bulk_item_errors(response):
+    '''
+    从bulk响应中找出失败的条目
+    :param response: es.bulk的返回值
+    :return: [(批次内位置, 状态码, 错误信息), ...]
+    '''
+    errors = []
+    if not response.get('errors'):
+        return errors
+    for pos, item in enumerate(response['items']):
+        result = list(item.values())[0]
+        if 'error' in result:
+            errors.append((pos, result.get('status'), result['error']))
+    return errors
+
+
+def _send_bulk_chunk(es, index_name, index_type, chunk):
+    '''
+    通过es客户端发送一个已序列化的bulk批次
+    :param chunk: _bulk_chunks生成的一个批次
+    :return: (成功条数, 失败条目列表)
+    '''
+    body = bulk_encoder.body(chunk)
+    response = es.bulk(index=index_name, doc_type=index_type, body=body)
+    errors = _bulk_item_errors(response)
+    return len(chunk) - len(errors), errors
+
+
+def _is_rejection(status, error):
+    '''
+    判断失败是否为集群bulk线程池拒绝(可重试)
+    '''
+    return status == 429 or (isinstance(error, dict) and error.get('type') == 'es_rejected_execution_exception')
+
+
+def _has_unacknowledged(errors):
+    '''
+    失败条目中是否有未得到集群确认的: 重试后仍被拒绝, 或请求超时、连接失败(status为None);
+    这样的批次可能没有写入, 不能确认(如前移断点); 只有mapping错误等条目级失败时批次才算完成
+    '''
+    return any(status is None or _is_rejection(status, error) for pos, status, error in errors)
+
+
+def _is_idempotent(chunk):
+    '''
+    批次重发是否不会改变结果: 每条action都需带_id, 且为index/create/delete或doc部分更新;
+    脚本更新重复执行会重复生效(如计数加两次), 不能重发
+    '''
+    for item in chunk:
+        op, meta = next(iter(json.loads(item[0]).items()))
+        if '_id' not in meta:
+            return False
+        if op == 'update':
+            if 'script' in json.loads(item[1]):
+                return False
+        elif op not in ('index', 'create', 'delete'):
+            return False
+    return True
+
+
+def _send_bulk_with_retry(es, index_name, index_type, chunk, backpressure):
+    '''
+    发送bulk批次, 只重试被拒绝(429)的条目, 重试间隔为带随机抖动的指数退避;
+    其他失败(如mapping错误)不重试, 直接计入失败;
+    请求超时时文档可能已经写入, 只有重发幂等时(见_is_idempotent)才重发整个批次, 否则整批计入失败
+    :param backpressure: BulkBackpressure实例, 记录拒绝/成功以调整批次大小和并发数
+    :return: (成功条数, 失败条目列表(位置对应原批次), 被拒绝次数)
+    '''
+    positions = range(len(chunk))
+    success = 0
+    failed = []
+    rejections = 0
+    attempt = 0
+    while True:
+        timed_out = False
+        try:
+            ok, errors = _send_bulk_chunk(es, index_name, index_type, chunk)
+        except ConnectionTimeout, e:
+            timed_out = True
+            ok, errors = 0, [(pos, None, str(e)) for pos in range(len(chunk))]
+        except TransportError, e:
+            # 整个请求被拒绝, 视为所有条目被拒绝
+            if e.status_code != 429:
+                raise
+            ok, errors = 0, [(pos, 429, str(e)) for pos in range(len(chunk))]
+        success += ok
+        errors = [(positions[pos], status, error) for pos, status, error in errors]
+        if timed_out and _is_idempotent(chunk):
+            retry = errors
+        else:
+            retry = [e for e in errors if _is_rejection(e[1], e[2])]
+            failed.extend(e for e in errors if not _is_rejection(e[1], e[2]))
+        if not retry:
+            backpressure.accepted()
+            break
+        rejections += 1
+        backpressure.rejected()
+        if attempt >= backpressure.max_retries:
+            failed.extend(retry)
+            break
+        time.sleep(backpressure.backoff(attempt))
+        attempt += 1
+        retry_positions = set(e[0] for e in retry)
+        retry_items = [(pos, item) for pos, item in zip(positions, chunk) if pos in retry_positions]
+        positions = [pos for pos, item in retry_items]
+        chunk = [item for pos, item in retry_items]
+    failed.sort(key=lambda e: e[0])
+    return success, failed, rejections
+
+
+class BulkBackpressure:
+    def __init__(self, chunk_size=DEFAULT_CHUNK_SIZE, concurrency=1, max_retries=DEFAULT_MAX_RETRIES,
+                 initial_backoff=DEFAULT_INITIAL_BACKOFF, max_backoff=DEFAULT_MAX_BACKOFF, min_chunk_size=10):
+        '''
+        bulk写入的自适应背压控制: 集群持续拒绝时批次条数和并发数减半,
+        拒绝停止后逐步增长回上限, 使吞吐稳定在集群实际能承受的水平
+        :param chunk_size: 每批条数上限
+        :param concurrency: 在途批次数上限
+        :param max_retries: 被拒绝条目的最大重试次数
+        :param initial_backoff: 第一次重试前的退避上限(秒), 之后每次翻倍
+        :param max_backoff: 退避时间上限(秒)
+        :param min_chunk_size: 批次条数下限
+        '''
+        self.max_chunk_size = self.chunk_size = chunk_size
+        self.max_concurrency = self.concurrency = concurrency
+        self.max_retries = max_retries
+        self.initial_backoff = initial_backoff
+        self.max_backoff = max_backoff
+        self.min_chunk_size = min(min_chunk_size, chunk_size)
+        self._last_decrease = 0
+        self._lock = threading.Lock()
+
+    def rejected(self):
+        '''
+        记录一次拒绝; 多个并发批次同时被拒绝时, initial_backoff时间内只减半一次
+        '''
+        with self._lock:
+            now = time.time()
+            if now - self._last_decrease < self.initial_backoff:
+                return
+            self._last_decrease = now
+            self.chunk_size = max(self.min_chunk_size, self.chunk_size // 2)
+            self.concurrency = max(1, self.concurrency // 2)
+
+    def accepted(self):
+        '''
+        记录一个未被拒绝的批次, 批次条数和并发数线性增长
+        '''
+        with self._lock:
+            self.chunk_size = min(self.max_chunk_size, self.chunk_size + max(1, self.max_chunk_size // 10))
+            self.concurrency = min(self.max_concurrency, self.concurrency + 1)
+
+    def backoff(self, attempt):
+        '''
+        第attempt次重试前的等待秒数: [0, initial_backoff * 2^attempt]内随机, 不超过max_backoff
+        '''
+        return random.uniform(0, min(self.max_backoff, self.initial_backoff * (2 ** attempt)))
+
+
+def _new_bulk_stats():
+    return {'batches': 0, 'success': 0, 'failed': 0, 'errors': []}
+
+
+def _add_bulk_stats(stats, success, errors):
+    '''
+    将一个批次的结果累加到统计信息中
+    '''
+    stats['batches'] += 1
+    stats['success'] += success
+    stats['failed'] += len(errors)
+    stats['errors'].extend(errors[:MAX_REPORTED_ERRORS - len(stats['errors'])])
+
+
+def _scroll_pages(es, index_name, doc_type, body, page_size, scroll, slice_id=None, slices=None):
+    '''
+    使用scroll逐页读取查询结果, 结束或中途退出时清除scroll上下文
+    :return: 生成器, 每项为一页hits
+    '''
+    body = dict(body or {})
+    body.setdefault('sort', ['_doc'])
+    if slices:
+        body['slice'] = {'id': slice_id, 'max': slices}
+    response = es.search(index=index_name, doc_type=doc_type, body=body, scroll=scroll, size=page_size)
+    scroll_id = response.get('_scroll_id')
+    try:
+        while response['hits']['hits']:
+            yield response['hits']['hits']
+            response = es.scroll(scroll_id=scroll_id, scroll=scroll)
+            scroll_id = response.get('_scroll_id', scroll_id)
+    finally:
+        if scroll_id:
+            es.clear_scroll(scroll_id=scroll_id, ignore=(404,))
+
+
+def _pit_pages(es, index_name, body, page_size, keep_alive, slice_id=None, slices=None):
+    '''
+    使用point in time + search_after逐页读取查询结果(需要ES 7.10+), 结束或中途退出时关闭point in time
+    :return: 生成器, 每项为一页hits
+    '''
+    pit_id = es.transport.perform_request('POST', _make_path(index_name, '_pit'),
+                                          params={'keep_alive': keep_alive})['id']
+    body = dict(body or {})
+    body.setdefault('sort', ['_shard_doc'])
+    body['size'] = page_size
+    body['pit'] = {'id': pit_id, 'keep_alive': keep_alive}
+    if slices:
+        body['slice'] = {'id': slice_id, 'max': slices}
+    try:
+        while True:
+            response = es.search(body=body)
+            hits = response['hits']['hits']
+            if not hits:
+                break
+            yield hits
+            body['search_after'] = hits[-1]['sort']
+            body['pit']['id'] = response.get('pit_id', body['pit']['id'])
+    finally:
+        es.transport.perform_request('DELETE', '/_pit', body={'id': body['pit']['id']}, params={'ignore': 404})
+
+
+# 并行分片读取时标记某个分片已读完
+_SLICE_DONE = object()
+
+
+def _put_until_stopped(queue, item, stop):
+    while not stop.is_set():
+        try:
+            queue.put(item, timeout=0.1)
+            return True
+        except Queue.Full:
+            pass
+    return False
+
+
+def _merge_slice_pages(sources, max_pages):
+    '''
+    每个分片在独立线程中读取, 通过有界队列交给调用方, 内存占用不超过max_pages页;
+    调用方提前退出时通知各线程停止并清理各自的scroll/point in time
+    :param sources: 每个分片的页生成器
+    :param max_pages: 队列中最多缓存的页数
+    :return: 生成器, 逐条返回所有分片的hit(不保证顺序)
+    '''
+    pages = Queue.Queue(max_pages)
+    stop = threading.Event()
+
+    def read(source):
+        try:
+            for page in source:
+                if not _put_until_stopped(pages, page, stop):
+                    break
+        except Exception, e:
+            _put_until_stopped(pages, e, stop)
+        finally:
+            source.close()
+            _put_until_stopped(pages, _SLICE_DONE, stop)
+
+    for source in sources:
+        t = threading.Thread(target=read, args=(source,))
+        t.daemon = True
+        t.start()
+    remaining = len(sources)
+    try:
+        while remaining:
+            page = pages.get()
+            if page is _SLICE_DONE:
+                remaining -= 1
+            elif isinstance(page, Exception):
+                raise page
+            else:
+                for hit in page:
+                    yield hit
+    finally:
+        stop.set()
+
+
+def _chunked(items, size):
+    '''
+    将序列按size条切分为列表
+    '''
+    items = iter(items)
+    while True:
+        chunk = list(itertools.islice(items, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def _map_concurrent(func, items, workers):
+    '''
+    在线程池中对每项调用func, 按输入顺序返回结果
+    '''
+    items = list(items)
+    if workers <= 1 or len(items) <= 1:
+        return [func(item) for item in items]
+    pool = ThreadPool(min(workers, len(items)))
+    try:
+        return pool.map(func, items)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def _flatten_source(source, prefix='', flat=None):
+    '''
+    将嵌套的_source展开为{'a.b': value}; 列表序列化为JSON字符串, unicode编码为utf-8以便写入csv
+    '''
+    if flat is None:
+        flat = {}
+    for key, value in source.items():
+        if isinstance(key, unicode):
+            key = key.encode('utf-8')
+        name = prefix + key
+        if isinstance(value, dict):
+            _flatten_source(value, name + '.', flat)
+        elif isinstance(value, list):
+            flat[name] = json.dumps(value)
+        elif isinstance(value, unicode):
+            flat[name] = value.encode('utf-8')
+        else:
+            flat[name] = value
+    return flat
+
+
+def _update_source(body, upsert):
+    '''
+    生成bulk update的source行: 部分更新{'doc': ...}或脚本更新{'script': ...};
+    upsert为True且body未指定upsert时, 部分更新使用doc_as_upsert, 脚本更新使用scripted_upsert
+    '''
+    if not upsert or 'upsert' in body:
+        return body
+    body = dict(body)
+    if 'doc' in body:
+        body['doc_as_upsert'] = True
+    else:
+        body['scripted_upsert'] = True
+        body['upsert'] = {}
+    return body
+
+
+# 按节点列表和连接参数共享的es客户端
+_shared_clients = {}
+_shared_clients_lock = threading.Lock()
+
+
+def _shared_client(hosts, options):
+    '''
+    返回进程内共享的es客户端, 相同节点和连接参数的ElasticObj复用同一个连接池
+    '''
+    key = (json.dumps(hosts, sort_keys=True), tuple(sorted(options.items())))
+    with _shared_clients_lock:
+        client = _shared_clients.get(key)
+        if client is None:
+            client = _shared_clients[key] = Elasticsearch(hosts, **options)
+        return client
+
+
+def _index_names(index_name):
+    '''
+    将index参数(None、'a,b'、['a', 'b'])规范化为排序后的元组, None表示所有索引
+    '''
+    if index_name is None:
+        return ('_all',)
+    if isinstance(index_name, basestring):
+        index_name = index_name.split(',')
+    return tuple(sorted(set(name.strip() for name in index_name)))
+
+
+class QueryCache:
+    def __init__(self, max_entries=DEFAULT_CACHE_ENTRIES, ttl=DEFAULT_CACHE_TTL):
+        '''
+        ElasticObj的查询结果缓存, 缓存searchDoc和getDocById的结果;
+        条目超过ttl秒过期, 超过max_entries时淘汰最久未使用的条目;
+        通过同一个ElasticObj写入时按index失效(通配符index的条目一并失效, 别名无法识别)
+        注意: 命中时返回的是缓存中的同一个对象, 调用方不应修改
+        :param max_entries: 最大条目数
+        :param ttl: 过期时间(秒)
+        '''
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def key(self, op, index_name, doc_type, body):
+        '''
+        由操作类型、规范化的index、type和查询语句生成缓存键
+        '''
+        return op, _index_names(index_name), doc_type, json.dumps(body, sort_keys=True)
+
+    def get(self, key):
+        '''
+        :return: 缓存的结果, 不存在或已过期时返回None
+        '''
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None or entry[0] < time.time():
+                self.misses += 1
+                return None
+            # 重新插入到末尾, 标记为最近使用
+            self._entries[key] = entry
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key, value):
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (time.time() + self.ttl, value)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, index_name=None):
+        '''
+        删除与写入的index相关的条目, index_name为None时清空缓存
+        '''
+        with self._lock:
+            self.invalidations += 1
+            if index_name is None:
+                self._entries.clear()
+                return
+            written = _index_names(index_name)
+            for key in list(self._entries):
+                if any(pattern == '_all' or fnmatch.fnmatchcase(name, pattern)
+                       for pattern in key[1] for name in written):
+                    del self._entries[key]
+
+    def stats(self):
+        '''
+        :return: 命中、未命中、淘汰、失效次数及当前条目数
+        '''
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions,
+                    'invalidations': self.invalidations, 'size': len(self._entries)}
+
+
+class _TimeIndexRouter:
+    def __init__(self, elastic_obj, index_name, index_type, time_column, time_interval, index_template, bulk_load):
+        '''
+        按日期列将文档路由到index_name-日期后缀的index, 首次遇到的index用index_template创建;
+        bulk_load为True时对涉及的每个index应用导入设置, finish()时恢复
+        '''
+        self.elastic_obj = elastic_obj
+        self.index_name = index_name
+        self.index_type = index_type
+        self.time_column = time_column
+        self.suffix_format = TIME_INDEX_FORMATS[time_interval]
+        self.index_template = index_template
+        self.bulk_load = bulk_load
+        self.targets = set()
+        self.original_settings = {}
+
+    def action(self, doc_id, value):
+        '''
+        :param value: 该文档日期列的原始文本
+        :return: 带_index和_type的index操作; 日期列为空或无法解析时写入index_name本身
+        '''
+        parsed = csvop.parse_date(value) if value else None
+        target = self.index_name if parsed is None else '%s-%s' % (self.index_name, parsed.strftime(self.suffix_format))
+        if target not in self.targets:
+            self.elastic_obj.create_index(target, self.index_template)
+            if self.bulk_load:
+                self.original_settings.update(self.elastic_obj._start_bulk_load(target))
+            self.targets.add(target)
+        meta = {'_index': target, '_type': self.index_type}
+        if doc_id is not None:
+            meta['_id'] = doc_id
+        return {'index': meta}
+
+    def finish(self):
+        self.elastic_obj._finish_bulk_load(self.original_settings)
 
 
 class ElasticObj:
-    def __init__(self, ip ="127.0.0.1"):
+    def __init__(self, ip ="127.0.0.1", cache=None, maxsize=DEFAULT_POOL_SIZE, timeout=DEFAULT_TIMEOUT,
+                 sniff=False, http_compress=False, http_auth=None, dead_timeout=DEFAULT_DEAD_TIMEOUT, shared=False):
+        '''
+        连接es, 多个节点时轮询发送请求, 失败的节点在dead_timeout秒内不再使用(连续失败时屏蔽时间指数增长);
+        每个节点维护一个keep-alive连接池, 连接在请求之间复用
+        :param ip: 节点地址, 如"127.0.0.1"、"host:9200", 或多个节点的列表
+        :param cache: QueryCache实例, 指定时缓存searchDoc、getDocById的结果
+        :param maxsize: 每个节点的连接池大小, 应不小于并发请求数
+        :param timeout: 请求超时(秒)
+        :param sniff: 启动时及节点失败时从集群获取全部节点, 并每隔DEFAULT_SNIFFER_TIMEOUT秒刷新
+        :param http_compress: 使用gzip压缩请求体
+        :param http_auth: 用户名密码, 如('elastic', 'password'); 为None时无用户名密码
+        :param dead_timeout: 失败节点的初始屏蔽时间(秒)
+        :param shared: 与进程内相同节点和参数的其他ElasticObj共享同一个客户端及连接池
+        '''
+        self.hosts = list(ip) if isinstance(ip, (list, tuple)) else [ip]
+        self.client_options = {'maxsize': maxsize, 'timeout': timeout, 'http_compress': http_compress,
+                               'dead_timeout': dead_timeout, 'selector_class': RoundRobinSelector}
+        if http_auth is not None:
+            self.client_options['http_auth'] = http_auth
+        if sniff:
+            self.client_options.update(sniff_on_start=True, sniff_on_connection_fail=True,
+                                       sniffer_timeout=DEFAULT_SNIFFER_TIMEOUT)
+        if shared:
+            self.es = _shared_client(self.hosts, self.client_options)
+        else:
+            self.es = Elasticsearch(self.hosts, **self.client_options)
+        self.cache = cache
+
+    def _invalidate(self, index_name):
         '''
-        :param index_name: 索引名称
-        :param index_type: 索引类型
+        写入index_name后使缓存中相关的查询结果失效
         '''
-        # 无用户名密码状态
-        self.es = Elasticsearch([ip])
-        #用户名密码状态
-        #self.es = Elasticsearch([ip],http_auth=('elastic', 'password'),port=9200)
+        if self.cache is not None:
+            self.cache.invalidate(index_name)
 
 
     def check(self):
@@ -42,6 +884,7 @@ class ElasticObj:
         '''
         if self.es.indices.exists(index=index_name) is not True:
             _created = self.es.indices.create(index=index_name, body=index_mappings)
+            self._invalidate(index_name)
             print(_created)
             return _created
 
@@ -56,6 +899,7 @@ class ElasticObj:
         :return:
         '''
         _inserted = self.es.index(index=index_name, doc_type=index_type, body=body, id=id)
+        self._invalidate(index_name)
         print(_inserted['result'])
         return _inserted
 
@@ -81,6 +925,209 @@ class ElasticObj:
                 print(res['result'])
             index += 1
             #print(index)
+        self._invalidate(index_name)
+
+    def bulk_index_fromCSV(self, index_name, index_type, csvfile,
+                           chunk_size=DEFAULT_CHUNK_SIZE, max_chunk_bytes=DEFAULT_MAX_CHUNK_BYTES,
+                           workers=1, max_in_flight=None, use_processes=False, max_retries=DEFAULT_MAX_RETRIES,
+                           bulk_load=False, infer_types=False, sample_rows=DEFAULT_SAMPLE_ROWS,
+                           id_columns=None, checkpoint=None,
+                           time_column=None, time_interval='day', index_template=None):
+        '''
+        流式读取CSV文件, 按条数和字节数分批通过bulk接口写入es;
+        文件逐行读取, 内存占用与文件大小无关, 每个批次输出一行统计信息;
+        集群拒绝(429)的条目带退避重试, 拒绝持续时自动缩小批次和并发数
+        :param csvfile: csv文件，包括完整路径
+        :param chunk_size: 每批最多文档条数
+        :param max_chunk_bytes: 每批请求体最大字节数
+        :param workers: 并行写入的线程/进程数, 为1时在当前线程顺序写入
+        :param max_in_flight: 同时在途(排队+发送中)的批次上限, 默认为workers的2倍
+        :param use_processes: 使用进程池代替线程池
+        :param max_retries: 被拒绝条目的最大重试次数
+        :param bulk_load: 导入期间关闭refresh和副本, 见bulk_load()
+        :param infer_types: 抽样推断各列类型, index不存在时按推断的mapping创建, 并在导入时转换各列的值
+        :param sample_rows: 推断类型时抽样的行数
+        :param id_columns: 由这些列的值的哈希生成文档id, 重复导入时覆盖而不是产生重复数据
+        :param checkpoint: 断点文件路径; 每个批次确认写入后记录CSV中的位置, 中断后再次调用时从该位置继续,
+                           全部写入后删除. 应与id_columns一起使用, 使断点之后重复写入的批次保持幂等
+        :param time_column: 日期列名, 指定时按该列写入index_name-日期后缀的index(如demo-2019.01.31),
+                            不同index的文档仍合并在同一批bulk请求中; 日期为空或无法解析的行写入index_name
+        :param time_interval: 按'day'、'month'或'year'划分index
+        :param index_template: 按时间路由时新建index使用的映射/设置, infer_types为True时使用推断的mapping
+        :return: 统计信息 {'batches': 批次数, 'success': 成功条数, 'failed': 失败条数, 'errors': 部分失败条目}
+        '''
+        types = None
+        if infer_types:
+            index_template, types = self.infer_mapping_fromCSV(csvfile, index_type, sample_rows)
+            if time_column is None:
+                self.create_index(index_name, index_template)
+        on_done = None
+        offset = row = 0
+        if checkpoint is not None:
+            checkpoint = IngestCheckpoint(checkpoint, csvfile)
+            on_done = checkpoint.done
+            offset, row = checkpoint.offset, checkpoint.row
+            if row:
+                print('resuming %s from row %d (byte %d)' % (csvfile, row, offset))
+        # 读到的最后一行的结束位置, 断点前移到这里才算全部写入
+        read_to = [offset]
+
+        def documents():
+            for item in _csv_documents(csvfile, types, id_columns, offset, row, time_column):
+                read_to[0] = item[2][0]
+                yield item
+
+        docs = documents()
+        if time_column is not None:
+            router = _TimeIndexRouter(self, index_name, index_type, time_column, time_interval,
+                                      index_template, bulk_load)
+            # 按原始文本解析日期, 不受infer_types转换(如YYYYMMDD推断为int)影响
+            lines = (bulk_encoder.encode(router.action(doc_id, raw_time), doc) + (position,)
+                     for doc_id, doc, position, raw_time in docs)
+            # 每条action自带_index和_type, 请求路径中不再指定
+            try:
+                stats = self._bulk_lines(None, None, lines, chunk_size, max_chunk_bytes,
+                                         workers, max_in_flight, use_processes, max_retries, on_done)
+            finally:
+                router.finish()
+        else:
+            lines = (bulk_encoder.encode({'index': {'_id': doc_id}} if doc_id else {'index': {}}, doc) + (position,)
+                     for doc_id, doc, position in docs)
+            if bulk_load:
+                with self.bulk_load(index_name):
+                    stats = self._bulk_lines(index_name, index_type, lines, chunk_size, max_chunk_bytes,
+                                             workers, max_in_flight, use_processes, max_retries, on_done)
+            else:
+                stats = self._bulk_lines(index_name, index_type, lines, chunk_size, max_chunk_bytes,
+                                         workers, max_in_flight, use_processes, max_retries, on_done)
+        if checkpoint is not None:
+            if checkpoint.offset == read_to[0] and not _has_unacknowledged(stats['errors']):
+                checkpoint.remove()
+            else:
+                checkpoint.save()
+                print('checkpoint %s kept at row %d, some batches were not written' % (checkpoint.path, checkpoint.row))
+        return stats
+
+    def infer_mapping_fromCSV(self, csvfile, index_type, sample_rows=DEFAULT_SAMPLE_ROWS):
+        '''
+        抽样CSV文件推断各列类型, 生成create_index可用的映射:
+        整数为long, 小数为double, 日期为date, 其他为keyword(不分词)
+        :param csvfile: csv文件，包括完整路径
+        :param index_type: 映射所属的type
+        :param sample_rows: 抽样的行数
+        :return: (index_mappings, csvop.infer_types的结果)
+        '''
+        types = csvop.infer_types(csvfile, sample_rows)
+        properties = dict((name, {'type': ES_FIELD_TYPES[field_type]}) for name, field_type in types)
+        return {'mappings': {index_type: {'properties': properties}}}, types
+
+    def _start_bulk_load(self, index_name):
+        '''
+        设置导入期间的refresh_interval和number_of_replicas
+        :return: 各index原来的设置
+        '''
+        original = {}
+        for name, data in self.es.indices.get_settings(index=index_name).items():
+            settings = data['settings']['index']
+            # 未显式设置的refresh_interval恢复为null, 即ES默认值
+            original[name] = {'refresh_interval': settings.get('refresh_interval'),
+                              'number_of_replicas': settings.get('number_of_replicas')}
+        self.es.indices.put_settings(index=index_name,
+                                     body={'index': {'refresh_interval': '-1', 'number_of_replicas': 0}})
+        return original
+
+    def _finish_bulk_load(self, original):
+        '''
+        恢复_start_bulk_load之前的设置并refresh
+        '''
+        for name, settings in original.items():
+            self.es.indices.put_settings(index=name, body={'index': settings})
+            self.es.indices.refresh(index=name)
+            self._invalidate(name)
+
+    @contextmanager
+    def bulk_load(self, index_name, force_merge=False, max_num_segments=None):
+        '''
+        大批量导入期间临时设置index的refresh_interval为-1、number_of_replicas为0;
+        导入结束或出错时恢复原设置并refresh, 导入成功且force_merge为True时再执行force merge
+        用法: with es.bulk_load('demo'): es.bulk_index_fromCSV('demo', 'test_df', 'data.csv')
+        :param index_name: 已存在的index, 可为多个或通配符
+        :param force_merge: 导入成功后执行force merge
+        :param max_num_segments: force merge后每个分片的段数, None时由ES决定
+        :return:
+        '''
+        original = self._start_bulk_load(index_name)
+        try:
+            yield
+        finally:
+            self._finish_bulk_load(original)
+        if force_merge:
+            self.es.indices.forcemerge(index=index_name, max_num_segments=max_num_segments,
+                                       request_timeout=DEFAULT_FORCE_MERGE_TIMEOUT)
+
+    def bulk_actions(self, index_name, index_type, actions,
+                     chunk_size=DEFAULT_CHUNK_SIZE, max_chunk_bytes=DEFAULT_MAX_CHUNK_BYTES,
+                     workers=1, max_in_flight=None, use_processes=False, max_retries=DEFAULT_MAX_RETRIES):
+        '''
+        将(action, source)序列分批写入es, 批次条数随背压自动调整
+        :param actions: 可迭代的(action, source)对, 如({'index': {'_id': 1}}, doc)、({'delete': {'_id': 1}}, None)
+        :return: 统计信息, 参数与返回值同bulk_index_fromCSV
+        '''
+        return self._bulk_lines(index_name, index_type, _serialize_actions(actions), chunk_size, max_chunk_bytes,
+                                workers, max_in_flight, use_processes, max_retries)
+
+    def bulk_insert_DataFrame(self, index_name, index_type, dataFrame, id_column=None,
+                              chunk_size=DEFAULT_CHUNK_SIZE, max_chunk_bytes=DEFAULT_MAX_CHUNK_BYTES,
+                              workers=1, max_in_flight=None, use_processes=False, max_retries=DEFAULT_MAX_RETRIES):
+        '''
+        分片将DataFrame序列化为NDJSON并分批写入es;
+        与insert_DataFrame不同, 不生成每行的dict及action列表, 也不把整个DataFrame放进一个请求
+        :param dataFrame: 待插入数据集
+        :param id_column: 作为文档_id的列名, 为None时由ES生成_id
+        :return: 统计信息, 其他参数与返回值同bulk_index_fromCSV
+        '''
+        lines = _dataframe_lines(dataFrame, id_column, chunk_size)
+        return self._bulk_lines(index_name, index_type, lines, chunk_size, max_chunk_bytes,
+                                workers, max_in_flight, use_processes, max_retries)
+
+    def _bulk_lines(self, index_name, index_type, lines, chunk_size, max_chunk_bytes,
+                    workers, max_in_flight, use_processes, max_retries, on_done=None):
+        '''
+        将已序列化的bulk请求行分批写入es, 批次条数和并发数由BulkBackpressure控制
+        '''
+        max_in_flight = max_in_flight or workers * 2
+        backpressure = BulkBackpressure(chunk_size, max_in_flight if workers > 1 else 1, max_retries)
+        chunks = _chunk_lines(lines, chunk_size, max_chunk_bytes, backpressure)
+        return self.bulk_chunks(index_name, index_type, chunks, workers, max_in_flight, use_processes, backpressure,
+                                on_done)
+
+    def bulk_chunks(self, index_name, index_type, chunks, workers=1, max_in_flight=None, use_processes=False,
+                    backpressure=None, on_done=None):
+        '''
+        将已分好的bulk批次写入es, workers大于1时交给ParallelBulkIndexer并行写入
+        :param chunks: _bulk_chunks生成的批次序列
+        :param backpressure: BulkBackpressure实例, 默认按DEFAULT_MAX_RETRIES重试被拒绝的条目
+        :param on_done: 每个批次完成后调用on_done(批次序号, 批次), 并行时可能乱序; 仍有被拒绝、超时或连接失败条目的批次不调用
+        :return: 统计信息, 并行时额外包含每个worker的统计 'workers'
+        '''
+        try:
+            if workers > 1:
+                indexer = ParallelBulkIndexer(self, workers, max_in_flight, use_processes, backpressure)
+                return indexer.run(index_name, index_type, chunks, on_done)
+            backpressure = backpressure or BulkBackpressure()
+            stats = _new_bulk_stats()
+            for seq, chunk in enumerate(chunks):
+                start = time.time()
+                success, errors, rejections = _send_bulk_with_retry(self.es, index_name, index_type, chunk,
+                                                                    backpressure)
+                _add_bulk_stats(stats, success, errors)
+                print('batch %d: %d docs, %d ok, %d failed, %d rejected, %.3fs' % (
+                    stats['batches'], len(chunk), success, len(errors), rejections, time.time() - start))
+                if on_done is not None and not _has_unacknowledged(errors):
+                    on_done(seq, chunk)
+            return stats
+        finally:
+            self._invalidate(index_name)
 
     def insert_DataFrame(self, index_name, index_type, dataFrame):
         '''
@@ -94,18 +1141,42 @@ class ElasticObj:
         :param dataFrame: 待插入数据集
         :return:
         '''
-        index_name = index_name
-        index_type = index_type
         dataList = dataFrame.to_dict(orient='records')
-        insertHeadInfoList = [{"index": {}} for i in range(len(dataList))]
-        temp = [dict] * (len(dataList) * 2)
-        temp[::2] = insertHeadInfoList
-        temp[1::2] = dataList
         try:
-            return self.es.bulk(index=index_name, doc_type=index_type, body=temp)
+            body = bulk_encoder.body(_serialize_actions(({"index": {}}, data) for data in dataList))
+            return self.es.bulk(index=index_name, doc_type=index_type, body=body)
         except Exception, e:
             return str(e)
+        finally:
+            self._invalidate(index_name)
+
 
+    def updateDocsByIds(self, index_name, index_type, items, upsert=False,
+                        chunk_size=DEFAULT_CHUNK_SIZE, max_chunk_bytes=DEFAULT_MAX_CHUNK_BYTES,
+                        workers=1, max_in_flight=None, use_processes=False, max_retries=DEFAULT_MAX_RETRIES):
+        '''
+        通过bulk update批量更新, 分批、重试及统计方式与bulk_index_fromCSV相同
+        :param items: 可迭代的(id, body), body与updateDocById相同:
+                      {"doc": {...}}部分更新, {"script": ...}脚本更新, 也可自带"upsert"
+        :param upsert: 文档不存在时插入: 部分更新以doc插入, 脚本更新以空文档执行脚本
+        :return: 统计信息, 其他参数与返回值同bulk_index_fromCSV
+        '''
+        actions = (({'update': {'_id': id}}, _update_source(body, upsert)) for id, body in items)
+        return self.bulk_actions(index_name, index_type, actions, chunk_size, max_chunk_bytes,
+                                 workers, max_in_flight, use_processes, max_retries)
+
+    def deleteDocsByIds(self, index_name, index_type, ids,
+                        chunk_size=DEFAULT_CHUNK_SIZE, max_chunk_bytes=DEFAULT_MAX_CHUNK_BYTES,
+                        workers=1, max_in_flight=None, use_processes=False, max_retries=DEFAULT_MAX_RETRIES):
+        '''
+        通过bulk delete批量删除指定id的数据, 分批、重试及统计方式与bulk_index_fromCSV相同;
+        不存在的id不计为失败
+        :param ids: 可迭代的id
+        :return: 统计信息, 其他参数与返回值同bulk_index_fromCSV
+        '''
+        actions = (({'delete': {'_id': id}}, None) for id in ids)
+        return self.bulk_actions(index_name, index_type, actions, chunk_size, max_chunk_bytes,
+                                 workers, max_in_flight, use_processes, max_retries)
 
     def deleteDocById(self, index_name, index_type, id):
         '''
@@ -115,7 +1186,9 @@ class ElasticObj:
         :param id:
         :return:
         '''
-        return self.es.delete(index=index_name, doc_type=index_type, id=id)
+        _deleted = self.es.delete(index=index_name, doc_type=index_type, id=id)
+        self._invalidate(index_name)
+        return _deleted
 
     def deleteDocByQuery(self, index_name, query, doc_type=None):
         '''
@@ -130,6 +1203,8 @@ class ElasticObj:
             return res
         except Exception, e:
             return str(e)
+        finally:
+            self._invalidate(index_name)
 
     def searchDoc(self, index_name=None, doc_type=None, body=None):
         '''
@@ -139,11 +1214,66 @@ class ElasticObj:
         :param body: 筛选语句,符合DSL语法格式
         :return:
         '''
+        if self.cache is not None:
+            key = self.cache.key('search', index_name, doc_type, body)
+            _searched = self.cache.get(key)
+            if _searched is not None:
+                return _searched
         _searched = self.es.search(index=index_name, doc_type=doc_type, body=body)
         #for hit in _searched['hits']['hits']:
             # print hit['_source']
+        if self.cache is not None:
+            self.cache.put(key, _searched)
         return _searched
 
+    def scanDoc(self, index_name, doc_type=None, body=None, page_size=DEFAULT_PAGE_SIZE, scroll=DEFAULT_SCROLL,
+                use_pit=False, slices=1):
+        '''
+        逐条返回index下所有符合条件的数据, 按页读取, 内存占用与结果总数无关
+        :param index_name:
+        :param doc_type: 仅scroll方式有效
+        :param body: 筛选语句,符合DSL语法格式; 未指定sort时按_doc(scroll)或_shard_doc(point in time)排序
+        :param page_size: 每页条数
+        :param scroll: scroll上下文或point in time的保持时间
+        :param use_pit: 使用point in time + search_after代替scroll(需要ES 7.10+)
+        :param slices: 大于1时按sliced scroll分片, 各分片在独立线程中并行读取, 返回顺序不固定
+        :return: hit生成器
+        '''
+        def pages(slice_id=None):
+            if use_pit:
+                return _pit_pages(self.es, index_name, body, page_size, scroll, slice_id, slices if slices > 1 else None)
+            return _scroll_pages(self.es, index_name, doc_type, body, page_size, scroll,
+                                 slice_id, slices if slices > 1 else None)
+
+        if slices > 1:
+            return _merge_slice_pages([pages(i) for i in range(slices)], slices * 2)
+        return (hit for page in pages() for hit in page)
+
+    def export_toCSV(self, index_name, csvfile, doc_type=None, body=None, columns=None,
+                     page_size=DEFAULT_PAGE_SIZE, scroll=DEFAULT_SCROLL, use_pit=False, slices=1):
+        '''
+        将查询结果通过scanDoc逐页读取, 展开嵌套字段后由csvop.write_csv逐行写入CSV文件
+        :param index_name:
+        :param csvfile: 输出的csv文件
+        :param doc_type:
+        :param body: 筛选语句,符合DSL语法格式
+        :param columns: 输出的列, 嵌套字段用'a.b'表示, '_id'为文档id; 只从es读取这些字段.
+                        为None时使用第一条结果的全部字段, 之后结果中多出的字段不输出
+        :return:
+        '''
+        body = dict(body or {})
+        if columns is not None:
+            body['_source'] = [column for column in columns if column != '_id'] or False
+        hits = self.scanDoc(index_name, doc_type, body, page_size, scroll, use_pit, slices)
+        docs = (_flatten_source(hit.get('_source', {}), flat={'_id': hit['_id'].encode('utf-8')}) for hit in hits)
+        if columns is None:
+            first = next(docs, None)
+            columns = ['_id'] + sorted(key for key in first if key != '_id') if first else ['_id']
+            if first:
+                docs = itertools.chain([first], docs)
+        rows = ([doc.get(column) for column in columns] for doc in docs)
+        csvop.write_csv(rows, csvfile, header=list(columns))
+
     def getDocById(self, index_name, doc_type, id):
         '''
         获取指定index_name、doc_type、id对应的数据
@@ -152,12 +1282,51 @@ class ElasticObj:
         :param id:
         :return:
         '''
+        if self.cache is not None:
+            key = self.cache.key('get', index_name, doc_type, id)
+            _searched = self.cache.get(key)
+            if _searched is not None:
+                return _searched
         _searched = self.es.get(index=index_name, doc_type=doc_type, id=id)
         #for hit in _searched['hits']['hits']:
             # print hit['_source']
+        if self.cache is not None:
+            self.cache.put(key, _searched)
         return _searched
 
 
+    def getDocsByIds(self, index_name, doc_type, ids, chunk_size=DEFAULT_MGET_SIZE, workers=DEFAULT_LOOKUP_WORKERS):
+        '''
+        批量获取指定id对应的数据, 按chunk_size个id一个_mget请求, 多个请求并发执行
+        :param index_name:
+        :param doc_type:
+        :param ids: id列表
+        :param chunk_size: 每个_mget请求的id数
+        :param workers: 并发请求数
+        :return: 与ids顺序一致的文档列表, 不存在的文档'found'为False
+        '''
+        def mget(chunk):
+            return self.es.mget(index=index_name, doc_type=doc_type, body={'ids': chunk})['docs']
+        return [doc for docs in _map_concurrent(mget, _chunked(ids, chunk_size), workers) for doc in docs]
+
+    def searchMany(self, index_name, doc_type, bodies, chunk_size=DEFAULT_MSEARCH_SIZE, workers=DEFAULT_LOOKUP_WORKERS):
+        '''
+        批量执行查询, 按chunk_size个查询一个_msearch请求, 多个请求并发执行
+        :param index_name:
+        :param doc_type:
+        :param bodies: 筛选语句列表,符合DSL语法格式
+        :param chunk_size: 每个_msearch请求的查询数
+        :param workers: 并发请求数
+        :return: 与bodies顺序一致的查询结果列表, 单个查询失败时对应结果中包含'error'
+        '''
+        header = bulk_encoder.dumps({}) + '\n'
+
+        def msearch(chunk):
+            body = bulk_encoder.body((header, bulk_encoder.dumps(query) + '\n') for query in chunk)
+            return self.es.msearch(index=index_name, doc_type=doc_type, body=body)['responses']
+        return [response for responses in _map_concurrent(msearch, _chunked(bodies, chunk_size), workers)
+                for response in responses]
+
     def updateDocById(self, index_name, doc_type, id, body=None):
         '''
         更新指定index_name、doc_type、id对应的数据
@@ -168,7 +1337,409 @@ class ElasticObj:
         :return:
         '''
         _updated = self.es.update(index=index_name, doc_type=doc_type, id=id, body=body)
+        self._invalidate(index_name)
         return _updated
 
 
 
+
+
+
+# 进程池模式下每个子进程各自持有的es客户端
+_worker_es = None
+
+
+def _init_bulk_worker(hosts, options):
+    global _worker_es
+    _worker_es = Elasticsearch(hosts, **options)
+
+
+def _bulk_worker(index_name, index_type, chunk, max_retries, initial_backoff, max_backoff):
+    '''
+    进程池中执行的bulk写入, 异常时整批记为失败, 保证回调总能释放在途名额;
+    子进程内用本地BulkBackpressure计算退避, 拒绝次数返回给主进程调整批次大小和并发数
+    :return: (worker名称, 成功条数, 失败条目列表, 被拒绝次数, 请求是否完成(未抛出异常))
+    '''
+    name = 'pid-%d' % os.getpid()
+    backpressure = BulkBackpressure(max_retries=max_retries, initial_backoff=initial_backoff, max_backoff=max_backoff)
+    try:
+        success, errors, rejections = _send_bulk_with_retry(_worker_es, index_name, index_type, chunk, backpressure)
+    except Exception, e:
+        return name, 0, [(pos, None, str(e)) for pos in range(len(chunk))], 0, False
+    return name, success, errors, rejections, True
+
+
+class _InFlightLimiter:
+    def __init__(self, limit):
+        '''
+        在途批次计数, 上限由limit()动态给出, 以便背压调整并发数
+        '''
+        self.limit = limit
+        self.count = 0
+        self._cond = threading.Condition()
+
+    def acquire(self):
+        with self._cond:
+            while self.count >= self.limit():
+                self._cond.wait()
+            self.count += 1
+
+    def release(self):
+        with self._cond:
+            self.count -= 1
+            self._cond.notify_all()
+
+
+class ParallelBulkIndexer:
+    def __init__(self, elastic_obj, workers=4, max_in_flight=None, use_processes=False, backpressure=None):
+        '''
+        并行bulk写入引擎, 将批次分发到线程池或进程池;
+        线程模式共享elastic_obj的es客户端(连接池线程安全), 进程模式每个子进程按elastic_obj的节点和连接参数新建客户端
+        :param elastic_obj: ElasticObj实例
+        :param workers: 线程/进程数
+        :param max_in_flight: 同时在途(排队+发送中)的批次上限, 限制内存占用, 默认为workers的2倍
+        :param use_processes: 使用进程池代替线程池, 适合序列化开销较大的场景
+        :param backpressure: BulkBackpressure实例, 集群拒绝时在max_in_flight以内自动降低在途批次数
+        '''
+        self.elastic_obj = elastic_obj
+        self.workers = workers
+        self.max_in_flight = max_in_flight or workers * 2
+        self.use_processes = use_processes
+        self.backpressure = backpressure or BulkBackpressure(concurrency=self.max_in_flight)
+        self._lock = threading.Lock()
+
+    def _record(self, stats, name, chunk_len, success, errors):
+        '''
+        累加总统计和每个worker的统计, 并输出该批次的结果
+        '''
+        with self._lock:
+            _add_bulk_stats(stats, success, errors)
+            worker = stats['workers'].setdefault(name, {'batches': 0, 'success': 0, 'failed': 0})
+            worker['batches'] += 1
+            worker['success'] += success
+            worker['failed'] += len(errors)
+            print('batch %d [%s]: %d docs, %d ok, %d failed' % (
+                stats['batches'], name, chunk_len, success, len(errors)))
+
+    def _fail(self, failure):
+        '''
+        记录第一个异常, 由run在所有批次结束后抛给调用方
+        '''
+        with self._lock:
+            if not failure:
+                failure.append(sys.exc_info())
+
+    def run(self, index_name, index_type, chunks, on_done=None):
+        '''
+        并行写入所有批次, 所有批次完成后返回
+        :param chunks: _bulk_chunks生成的批次序列
+        :param on_done: 每个批次完成后调用on_done(批次序号, 批次), 调用顺序不保证与批次顺序一致;
+                        请求异常或仍有被拒绝、超时条目的批次不调用; on_done抛出异常时停止分发, 异常抛给调用方
+        :return: 统计信息, 'workers'中为每个worker的成功/失败条数
+        '''
+        stats = _new_bulk_stats()
+        stats['workers'] = {}
+        in_flight = _InFlightLimiter(lambda: min(self.max_in_flight, self.backpressure.concurrency))
+        failure = []
+        if self.use_processes:
+            self._run_processes(index_name, index_type, chunks, stats, in_flight, on_done, failure)
+        else:
+            self._run_threads(index_name, index_type, chunks, stats, in_flight, on_done, failure)
+        if failure:
+            exc_type, exc_value, exc_tb = failure[0]
+            raise exc_type, exc_value, exc_tb
+        return stats
+
+    def _run_threads(self, index_name, index_type, chunks, stats, in_flight, on_done, failure):
+        tasks = Queue.Queue()
+
+        def send(name, seq, chunk):
+            sent = True
+            try:
+                success, errors, rejections = _send_bulk_with_retry(
+                    self.elastic_obj.es, index_name, index_type, chunk, self.backpressure)
+            except Exception, e:
+                sent = False
+                success, errors = 0, [(pos, None, str(e)) for pos in range(len(chunk))]
+            self._record(stats, name, len(chunk), success, errors)
+            if sent and on_done is not None and not _has_unacknowledged(errors):
+                with self._lock:
+                    on_done(seq, chunk)
+
+        def work():
+            name = threading.current_thread().name
+            while True:
+                task = tasks.get()
+                if task is None:
+                    break
+                try:
+                    # 已有批次出错时丢弃剩余批次
+                    if not failure:
+                        send(name, *task)
+                except Exception:
+                    self._fail(failure)
+                finally:
+                    in_flight.release()
+
+        threads = [threading.Thread(target=work, name='bulk-%d' % i) for i in range(self.workers)]
+        for t in threads:
+            t.daemon = True
+            t.start()
+        try:
+            for task in enumerate(chunks):
+                in_flight.acquire()
+                if failure:
+                    in_flight.release()
+                    break
+                tasks.put(task)
+        finally:
+            for t in threads:
+                tasks.put(None)
+            for t in threads:
+                t.join()
+
+    def _run_processes(self, index_name, index_type, chunks, stats, in_flight, on_done, failure):
+        pool = multiprocessing.Pool(self.workers, _init_bulk_worker,
+                                    (self.elastic_obj.hosts, self.elastic_obj.client_options))
+        backpressure = self.backpressure
+
+        def done(seq, chunk, result):
+            # 回调在pool的结果线程中执行, 异常会使该线程退出, 因此记录下来交给run抛出
+            try:
+                name, success, errors, rejections, sent = result
+                if rejections:
+                    backpressure.rejected()
+                else:
+                    backpressure.accepted()
+                self._record(stats, name, len(chunk), success, errors)
+                if sent and on_done is not None and not _has_unacknowledged(errors) and not failure:
+                    on_done(seq, chunk)
+            except Exception:
+                self._fail(failure)
+            finally:
+                in_flight.release()
+
+        try:
+            for seq, chunk in enumerate(chunks):
+                in_flight.acquire()
+                if failure:
+                    in_flight.release()
+                    break
+                pool.apply_async(_bulk_worker, (index_name, index_type, chunk, backpressure.max_retries,
+                                                backpressure.initial_backoff, backpressure.max_backoff),
+                                 callback=lambda result, seq=seq, chunk=chunk: done(seq, chunk, result))
+            if failure:
+                pool.terminate()
+            else:
+                pool.close()
+            pool.join()
+        except:
+            pool.terminate()
+            raise
+
+
+# 通知BufferedWriter后台线程刷新剩余数据并退出
+_WRITER_STOP = object()
+
+
+def _close_writer(ref):
+    '''
+    进程退出时关闭仍未关闭的BufferedWriter; 只持有弱引用, 已关闭的writer可以被回收
+    '''
+    writer = ref()
+    if writer is not None:
+        writer.close()
+
+
+class BufferedWriter:
+    def __init__(self, elastic_obj, max_docs=DEFAULT_BUFFER_DOCS, max_bytes=DEFAULT_BUFFER_BYTES,
+                 flush_interval=DEFAULT_FLUSH_INTERVAL, max_queue=DEFAULT_BUFFER_QUEUE,
+                 max_retries=DEFAULT_MAX_RETRIES):
+        '''
+        insert_one_document的缓冲写入版本: 文档先放入有界队列, 由后台线程在达到条数、字节数
+        或等待时间阈值时合并为一个bulk请求写入; 队列满时insert_one_document阻塞, 对调用方形成背压.
+        退出前调用close()(或使用with语句)写入剩余数据, 进程正常退出时也会自动调用
+        :param elastic_obj: ElasticObj实例
+        :param max_docs: 缓冲达到多少条时写入
+        :param max_bytes: 缓冲达到多少字节时写入
+        :param flush_interval: 第一条文档进入缓冲后最多等待多少秒写入
+        :param max_queue: 队列中最多等待的文档数
+        :param max_retries: 被拒绝条目的最大重试次数
+        '''
+        self.elastic_obj = elastic_obj
+        self.max_docs = max_docs
+        self.max_bytes = max_bytes
+        self.flush_interval = flush_interval
+        self.backpressure = BulkBackpressure(max_docs, max_retries=max_retries)
+        self.stats = _new_bulk_stats()
+        self._queue = Queue.Queue(max_queue)
+        self._closed = False
+        # 保证关闭后不再有文档或flush请求排在_WRITER_STOP之后
+        self._lock = threading.Lock()
+        self._thread = threading.Thread(target=self._run, name='buffered-writer')
+        self._thread.daemon = True
+        self._thread.start()
+        atexit.register(_close_writer, weakref.ref(self))
+
+    def insert_one_document(self, index_name, index_type, body, id=None):
+        '''
+        参数同ElasticObj.insert_one_document, 文档进入缓冲后立即返回
+        '''
+        meta = {'_index': index_name, '_type': index_type}
+        if id is not None:
+            meta['_id'] = id
+        lines = bulk_encoder.encode({'index': meta}, body)
+        with self._lock:
+            if self._closed:
+                raise ValueError('BufferedWriter is closed')
+            self._queue.put((index_name, lines))
+
+    def flush(self):
+        '''
+        等待此前放入的文档全部写入es
+        '''
+        done = threading.Event()
+        with self._lock:
+            if self._closed:
+                raise ValueError('BufferedWriter is closed')
+            self._queue.put(done)
+        done.wait()
+
+    def close(self):
+        '''
+        写入剩余数据并停止后台线程, 可重复调用
+        '''
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+            self._queue.put(_WRITER_STOP)
+        self._thread.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def _send(self, chunk, indices):
+        try:
+            success, errors, rejections = _send_bulk_with_retry(self.elastic_obj.es, None, None, chunk,
+                                                                self.backpressure)
+        except Exception, e:
+            success, errors = 0, [(pos, None, str(e)) for pos in range(len(chunk))]
+        _add_bulk_stats(self.stats, success, errors)
+        for index_name in indices:
+            self.elastic_obj._invalidate(index_name)
+        if errors:
+            print('buffered batch %d: %d docs, %d ok, %d failed' % (
+                self.stats['batches'], len(chunk), success, len(errors)))
+
+    def _run(self):
+        chunk = []
+        chunk_bytes = 0
+        indices = set()
+        deadline = None
+        while True:
+            try:
+                if chunk:
+                    item = self._queue.get(timeout=max(0, deadline - time.time()))
+                else:
+                    item = self._queue.get()
+            except Queue.Empty:
+                item = None
+            if isinstance(item, tuple):
+                index_name, lines = item
+                if not chunk:
+                    deadline = time.time() + self.flush_interval
+                chunk.append(lines)
+                chunk_bytes += len(lines[0]) + len(lines[1])
+                indices.add(index_name)
+                if len(chunk) < self.max_docs and chunk_bytes < self.max_bytes:
+                    continue
+            if chunk:
+                self._send(chunk, indices)
+                chunk = []
+                chunk_bytes = 0
+                indices = set()
+            if item is _WRITER_STOP:
+                return
+            if item is not None and not isinstance(item, tuple):
+                # flush()放入的Event
+                item.set()
+
+
+class AsyncElasticObj:
+    def __init__(self, ip="127.0.0.1", max_concurrency=100, cache=None):
+        '''
+        ElasticObj的非阻塞版本, 提供与ElasticObj相同的方法(searchDoc、getDocById、insert_one_document、updateDocById等),
+        调用时立即返回AsyncResult, 请求在线程池中执行; 线程池大小即并发上限
+        :param ip: es地址, 同ElasticObj
+        :param max_concurrency: 同时执行的最大请求数, 超出的调用排队等待
+        :param cache: QueryCache实例, 同ElasticObj
+        '''
+        # 连接池大小与并发上限一致, 避免并发请求争用连接或反复新建连接
+        self.sync = ElasticObj(ip, cache, maxsize=max_concurrency)
+        self.max_concurrency = max_concurrency
+        self.pool = ThreadPool(max_concurrency)
+
+    def __getattr__(self, name):
+        method = getattr(self.sync, name)
+        if not callable(method):
+            return method
+
+        def submit(*args, **kwargs):
+            return self.pool.apply_async(method, args, kwargs)
+        return submit
+
+    def gather(self, results, timeout=None):
+        '''
+        等待一组调用全部完成, 按传入顺序返回结果; 任一调用抛出异常时重新抛出
+        用法: obj.gather([obj.getDocById('demo', 'test_df', i) for i in ids])
+        :param results: 方法调用返回的AsyncResult列表
+        :param timeout: 每个结果的最长等待秒数
+        :return: 结果列表
+        '''
+        return [result.get(timeout) for result in results]
+
+    def close(self):
+        '''
+        等待所有已提交的请求完成后关闭线程池
+        '''
+        self.pool.close()
+        self.pool.join()
+
+
+def _export_process(args):
+    es = ElasticObj(args.host.split(','))
+    body = json.loads(args.query) if args.query else None
+    columns = args.columns.split(',') if args.columns else None
+    return es.export_toCSV(args.index, args.output, args.type, body, columns,
+                           page_size=args.page_size, use_pit=args.pit, slices=args.slices)
+
+
+def _export_args(parser):
+    parser.add_argument('index', metavar="INDEX", help='The index to export from')
+    parser.add_argument('output', metavar="OUTPUT_CSV", help='A csv file to write to')
+    parser.add_argument('--type', '-t', help='The document type', required=False)
+    parser.add_argument('--query', '-q', help='The search body as JSON (match_all by default)', required=False)
+    parser.add_argument('--columns', '-c', help='Comma separated fields to export, e.g. _id,name,address.city')
+    parser.add_argument('--page-size', type=int, default=DEFAULT_PAGE_SIZE, help='Hits fetched per page')
+    parser.add_argument('--pit', action='store_true', help='Use point in time + search_after instead of scroll')
+    parser.add_argument('--slices', type=int, default=1, help='Number of slices read in parallel')
+    parser.set_defaults(func=_export_process)
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Perform operations on Elasticsearch")
+    parser.add_argument('--host', default='127.0.0.1', help='Comma separated Elasticsearch nodes')
+    subparsers = parser.add_subparsers(metavar="COMMAND")
+
+    # create the parser for the "export" command
+    export_parser = subparsers.add_parser('export', help='export search results to a csv file')
+    _export_args(export_parser)
+
+    args = parser.parse_args()
+    args.func(args)
@@ -2,11 +2,16 @@
 
 import csv
 import csvop
-from es_connect_test import ElasticObj
+from es_connect_test import ElasticObj, AsyncElasticObj, QueryCache, BufferedWriter
 from elasticsearch import Elasticsearch
 from elasticsearch.helpers import bulk
 
 es =ElasticObj()
+# 缓存查询结果, 最多1000条, 30秒过期; 通过es写入时相关index的缓存自动失效
+# es = ElasticObj(cache=QueryCache(max_entries=1000, ttl=30))
+# print(es.cache.stats())
+# 多节点轮询, 每节点20个连接, 同进程内共享连接池
+# es = ElasticObj(['10.0.0.1:9200', '10.0.0.2:9200'], maxsize=20, http_compress=True, http_auth=('elastic', 'password'), shared=True)
 
 #print(es.check())
 
@@ -18,12 +23,31 @@ es =ElasticObj()
 #     }
 # }}
 # es.create_index('nametest', doc_mappings)
+# 由CSV抽样推断mapping: 数值为long/double, 日期为date, 其他为keyword
+# doc_mappings, types = es.infer_mapping_fromCSV('HYL_AH_Data.csv', 'testtype')
+# es.create_index('testname', doc_mappings)
 
 #es.insert_one_document("ott", "ott_type", {"S6406527": "9264","S0068565": "20464","S0068690": "10412","DATETIME": "2019-01-31"})
+#缓冲写入: 每500条或1秒合并为一个bulk请求
+#with BufferedWriter(es, max_docs=500, flush_interval=1.0) as writer:
+#    writer.insert_one_document("ott", "ott_type", {"S6406527": "9264","S0068565": "20464","S0068690": "10412","DATETIME": "2019-01-31"})
 
 
 
 #es.index_data_fromCSV('testname', 'testtype', 'HYL_AH_Data.csv')
+#流式分批导入, 每批最多1000条/5MB
+#print(es.bulk_index_fromCSV('testname', 'testtype', 'HYL_AH_Data.csv', chunk_size=1000, max_chunk_bytes=5 * 1024 * 1024))
+#8个线程并行写入, 最多16个批次在途
+#print(es.bulk_index_fromCSV('testname', 'testtype', 'HYL_AH_Data.csv', workers=8, max_in_flight=16))
+#按推断的类型建索引并转换数值/日期
+#print(es.bulk_index_fromCSV('testname', 'testtype', 'HYL_AH_Data.csv', infer_types=True))
+#可断点续传: id由DATETIME列计算, 中断后以同样参数再次执行即从断点继续
+#print(es.bulk_index_fromCSV('testname', 'testtype', 'HYL_AH_Data.csv', id_columns=['DATETIME'], checkpoint='HYL_AH_Data.ckpt'))
+#按DATETIME列写入按月划分的index: ott-2019.01、ott-2019.02...
+#print(es.bulk_index_fromCSV('ott', 'ott_type', 'HYL_AH_Data.csv', time_column='DATETIME', time_interval='month', infer_types=True))
+#导入期间关闭refresh和副本, 完成后恢复并force merge
+#with es.bulk_load('testname', force_merge=True, max_num_segments=1):
+#    es.bulk_index_fromCSV('testname', 'testtype', 'HYL_AH_Data.csv', workers=8)
 
 
 # _index = 'demo'
@@ -36,6 +60,8 @@ es =ElasticObj()
 # print(frame)
 
 # print(es.insert_DataFrame(_index, _type, frame))
+# 分片序列化写入, 以name列作为_id
+# print(es.bulk_insert_DataFrame(_index, _type, frame, id_column='name'))
 
 
 # host = 'localhost:9200'
@@ -66,9 +92,22 @@ es =ElasticObj()
 # query = {'query': {'match': {'age': 1000}}}
 # print es.searchDoc('demo', 'test_df', query)
 # print(es.searchDoc())
+# 逐条导出所有结果, 4个分片并行读取
+# for hit in es.scanDoc('demo', 'test_df', {'query': {'match_all': {}}}, page_size=5000, slices=4):
+#     print hit['_source']
+
+# 并发查询: 调用立即返回, gather按顺序取回结果
+# aes = AsyncElasticObj(max_concurrency=50)
+# print aes.gather([aes.getDocById('demo', 'test_df', i) for i in ['id1', 'id2', 'id3']])
+# aes.close()
+
+# 导出到CSV, 只读取需要的字段; 命令行: python es_connect_test.py export demo out.csv -c _id,name,age
+# es.export_toCSV('demo', 'demo_export.csv', 'test_df', {'query': {'match_all': {}}}, columns=['_id', 'name', 'age'])
 
 # Get API
 # print es.getDocById('demo', 'test_df', 'aDXsoGIBo1UAretD2N4p')
+# print es.getDocsByIds('demo', 'test_df', ['aDXsoGIBo1UAretD2N4p', 'aTXsoGIBo1UAretD2N4p'])
+# print es.searchMany('demo', 'test_df', [{'query': {'term': {'name': 'jackaaa'}}}, {'query': {'range': {'age': {'gt': 11}}}}])
 
 
 # Update API
@@ -76,11 +115,14 @@ es =ElasticObj()
 # body = {'script': "ctx._source.age = 40"}#增加字段
 # body = {"doc": {"name": 'jackaaa'}}#修改部分字段
 # print es.updateDocById('demo', 'test_df', 'aDXsoGIBo1UAretD2N4p', body)
+# 批量更新, 不存在时插入
+# print es.updateDocsByIds('demo', 'test_df', [('id1', {"doc": {"age": 1}}), ('id2', {'script': "ctx._source.age = 40"})], upsert=True)
 
 
 # Delete API
 # body = {"query": {"name": 'jackbbb', 'sex': 'male'}}
 # print es.deleteDocById('demo', 'test_df', 'aDXsoGIBo1UAretD2N4p')
+# print es.deleteDocsByIds('demo', 'test_df', ['id1', 'id2'])
 
 # Delete_By_Query API
 # query = {'query': {'match': {'sex': 'male'}}}